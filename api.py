@@ -1,15 +1,16 @@
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import os
-import json
+import re
+import orjson
 import subprocess
 from werkzeug.utils import secure_filename
 import threading
 import time
+import logging
 import shutil
-
-# Import the Python converter
-from python_converter_final import convert_to_pdf_python
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as StepTimeout
 
 app = Flask(__name__)
 
@@ -38,6 +39,13 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 ALLOWED_OFFER1_EXTENSIONS = {'pdf', 'docx', 'doc', 'xlsx', 'xls', 'png', 'jpg', 'jpeg'}
 ALLOWED_OFFER2_EXTENSIONS = {'docx', 'doc', 'xlsx', 'xls', 'pdf'}
 
+# A spreadsheet row naming any pricing column starts the template table
+TABLE_HEADER_RE = re.compile(r'POSITION|DESCRIPTION|PRICE|QUANTITY|TOTAL', re.IGNORECASE)
+
+# Pipeline scripts run in-process; REQUOTE_ISOLATED=1 runs each one in its
+# own Python subprocess again (for debugging module-state issues)
+RUN_ISOLATED = os.environ.get('REQUOTE_ISOLATED', '').lower() in ('1', 'true', 'yes')
+
 # Thread-safe status storage
 _status_lock = threading.Lock()
 processing_status = {
@@ -73,6 +81,7 @@ def convert_to_docx_python(input_path, output_path, file_format):
             import fitz
             from docx import Document
             from docx.shared import Pt, RGBColor
+            from docx.table import _Cell
             
             print("Converting PDF template to DOCX with table extraction...", flush=True)
             pdf_doc = fitz.open(input_path)
@@ -80,7 +89,10 @@ def convert_to_docx_python(input_path, output_path, file_format):
             
             for page_num in range(len(pdf_doc)):
                 page = pdf_doc[page_num]
-                tables = page.find_tables()
+                
+                # Table detection works from ruling lines; pages without any
+                # vector graphics skip the (slow) page layout analysis
+                tables = page.find_tables() if page.get_cdrawings() else []
                 
                 if tables:
                     print(f"  Found {len(tables)} table(s) on page {page_num + 1}", flush=True)
@@ -96,11 +108,12 @@ def convert_to_docx_python(input_path, output_path, file_format):
                             docx_table = docx_doc.add_table(rows=num_rows, cols=num_cols)
                             docx_table.style = 'Light Grid Accent 1'
                             
-                            for row_idx, row_data in enumerate(table_data):
-                                for col_idx, cell_text in enumerate(row_data):
-                                    if col_idx < num_cols:
-                                        cell = docx_table.rows[row_idx].cells[col_idx]
-                                        cell.text = str(cell_text) if cell_text else ""
+                            # Walk <w:tr>/<w:tc> once; rows[i].cells[j] rebuilds
+                            # the whole cell grid on every lookup
+                            for tr, row_data in zip(docx_table._tbl.tr_lst, table_data):
+                                for tc, cell_text in zip(tr.tc_lst, row_data):
+                                    cell = _Cell(tc, docx_table)
+                                    cell.text = str(cell_text) if cell_text else ""
                 else:
                     text = page.get_text()
                     if text.strip():
@@ -123,26 +136,34 @@ def convert_to_docx_python(input_path, output_path, file_format):
             from docx import Document
             from docx.shared import Pt
             from docx.enum.text import WD_ALIGN_PARAGRAPH
+            from docx.table import _Cell
             
             print(f"Converting {file_format.upper()} template to DOCX...", flush=True)
-            workbook = openpyxl.load_workbook(input_path, data_only=True)
-            sheet = workbook.active
-            docx_doc = Document()
+            # Only cell values are needed: read-only mode streams the sheet
+            # XML instead of building a Cell object for every cell
+            workbook = openpyxl.load_workbook(input_path, read_only=True, data_only=True)
+            try:
+                sheet = workbook.active
+                # Don't trust the stored <dimension> tag (exporters can
+                # write a stale "A1"); read the rows as they actually are
+                sheet.reset_dimensions()
+                
+                # The table header (first row naming a pricing column) is
+                # found while the rows are read, not in a second scan
+                all_rows = []
+                table_start_row = None
+                for row in sheet.iter_rows(values_only=True):
+                    row_data = [str(cell) if cell is not None else '' for cell in row]
+                    if table_start_row is None and TABLE_HEADER_RE.search(' '.join(row_data)):
+                        table_start_row = len(all_rows)
+                    all_rows.append(row_data)
+            finally:
+                workbook.close()
             
-            all_rows = []
-            for row in sheet.iter_rows(values_only=True):
-                row_data = [str(cell) if cell is not None else '' for cell in row]
-                all_rows.append(row_data)
+            docx_doc = Document()
             
             print(f"  Found {len(all_rows)} rows in Excel", flush=True)
             
-            table_start_row = None
-            for idx, row in enumerate(all_rows):
-                row_text = ' '.join(row).upper()
-                if any(keyword in row_text for keyword in ['POSITION', 'DESCRIPTION', 'PRICE', 'QUANTITY', 'TOTAL']):
-                    table_start_row = idx
-                    break
-            
             if table_start_row is None:
                 table_start_row = 0
             
@@ -163,15 +184,20 @@ def convert_to_docx_python(input_path, output_path, file_format):
                 docx_table = docx_doc.add_table(rows=num_rows, cols=num_cols)
                 docx_table.style = 'Light Grid Accent 1'
                 
-                for row_idx, row_data in enumerate(table_rows):
-                    for col_idx in range(num_cols):
-                        cell_text = row_data[col_idx] if col_idx < len(row_data) else ''
-                        docx_table.rows[row_idx].cells[col_idx].text = cell_text
-                        
-                        if row_idx == 0:
-                            for paragraph in docx_table.rows[row_idx].cells[col_idx].paragraphs:
-                                for run in paragraph.runs:
-                                    run.font.bold = True
+                # Walk <w:tr>/<w:tc> once (see the PDF branch); zip stops at
+                # the end of short rows, their remaining cells stay empty
+                header_tr, *data_trs = docx_table._tbl.tr_lst
+                
+                # Header: create the single run already bold instead of
+                # setting text and re-walking paragraphs/runs
+                for tc, cell_text in zip(header_tr.tc_lst, table_rows[0]):
+                    _Cell(tc, docx_table).paragraphs[0].add_run(cell_text).font.bold = True
+                
+                # Data: fresh cells hold one empty <w:p>, add the run to it
+                for tr, row_data in zip(data_trs, table_rows[1:]):
+                    for tc, cell_text in zip(tr.tc_lst, row_data):
+                        if cell_text:
+                            tc.p_lst[0].add_r().text = cell_text
             
             docx_doc.save(output_path)
             print(f"✓ {file_format.upper()} converted to DOCX template", flush=True)
@@ -206,6 +232,112 @@ def home():
         }
     })
 
+# In-process steps still running, by script name: (future, cancel event).
+# A step that timed out is told to stop, but its thread cannot be killed -
+# the same step is not started again until that thread has finished
+_running_steps = {}
+_steps_lock = threading.Lock()
+
+class StepErrorRecorder(logging.Handler):
+    """Keeps the last ERROR message a pipeline step logs from its own thread"""
+    
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.thread = None
+        self.message = ''
+    
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.message = record.getMessage().strip()
+
+def run_pipeline_step(script_name, step, timeout, log_name):
+    """
+    Run one pipeline script: call step(cancel), its entry function, in this
+    process, or spawn the script when RUN_ISOLATED is set. Returns
+    (success, details), details being the last error the step logged (or
+    its stderr)
+    """
+    if RUN_ISOLATED:
+        result = subprocess.run(
+            ['python', os.path.join(BASE_DIR, script_name)],
+            capture_output=True,
+            text=True,
+            cwd=BASE_DIR,
+            timeout=timeout
+        )
+        
+        if result.stdout:
+            print(result.stdout, flush=True)
+        if result.stderr:
+            print(result.stderr, flush=True)
+        
+        return result.returncode == 0, result.stderr
+    
+    # The steps catch their own errors and return False, so their last
+    # logged error is recorded to report as details
+    step_log = logging.getLogger(log_name)
+    recorder = StepErrorRecorder()
+    cancel = threading.Event()
+    
+    def run_step():
+        recorder.thread = threading.get_ident()
+        return step(cancel)
+    
+    # The step runs on its own thread so it can be bounded by timeout. On
+    # timeout it is cancelled: it stops at its next phase boundary and
+    # writes no output (see pipeline_common.check_cancelled)
+    with _steps_lock:
+        previous = _running_steps.get(script_name)
+        if previous is not None and not previous[0].done():
+            print(f"✗ {script_name} is still running from an earlier request", flush=True)
+            return False, f"{script_name} is still running from an earlier request, try again shortly"
+        
+        step_log.addHandler(recorder)
+        pool = ThreadPoolExecutor(max_workers=1)
+        future = pool.submit(run_step)
+        _running_steps[script_name] = (future, cancel)
+    
+    try:
+        success = bool(future.result(timeout=timeout))
+        return success, '' if success else recorder.message
+    except StepTimeout:
+        cancel.set()
+        print(f"✗ {script_name} timed out after {timeout}s, cancelled", flush=True)
+        return False, f"{script_name} timed out after {timeout}s"
+    except Exception as e:
+        print(f"✗ {script_name} failed: {str(e)}", flush=True)
+        import traceback
+        traceback.print_exc()
+        return False, str(e)
+    finally:
+        pool.shutdown(wait=False)
+        step_log.removeHandler(recorder)
+
+def run_extract_items(cancel):
+    from extract_pdf_direct_enhanced import extract_items_from_pdf
+    return extract_items_from_pdf(
+        os.path.join(UPLOAD_FOLDER, 'offer1.pdf'),
+        os.path.join(OUTPUT_FOLDER, 'items_offer1.json'),
+        cancel=cancel
+    )
+
+def run_extract_company_data(cancel):
+    from extract_company_data import extract_company_data_from_offer2
+    return extract_company_data_from_offer2(
+        os.path.join(BASE_DIR, 'offer2_template.docx'),
+        os.path.join(OUTPUT_FOLDER, 'company_data.json'),
+        cancel=cancel
+    )
+
+def run_build_offer3(cancel):
+    from build_offer3 import generate_offer3
+    return generate_offer3(
+        os.path.join(OUTPUT_FOLDER, 'company_data.json'),
+        os.path.join(OUTPUT_FOLDER, 'items_offer1.json'),
+        os.path.join(OUTPUT_FOLDER, 'final_offer3.docx'),
+        cancel=cancel
+    )
+
 def process_file_background(filepath, file_extension):
     """Background processing using semantic extraction"""
     global processing_status
@@ -229,6 +361,9 @@ def process_file_background(filepath, file_extension):
             with _status_lock:
                 processing_status['message'] = f'Converting {file_extension.upper()} to PDF...'
             
+            # ReportLab is only needed for non-PDF offers, so it is imported
+            # here rather than at startup (like the pipeline steps)
+            from python_converter_final import convert_to_pdf_python
             conversion_success = convert_to_pdf_python(filepath, pdf_path, file_extension)
             if not conversion_success:
                 with _status_lock:
@@ -240,24 +375,17 @@ def process_file_background(filepath, file_extension):
             processing_status['message'] = 'Extracting items with semantic analysis...'
         
         items_output_path = os.path.join(OUTPUT_FOLDER, 'items_offer1.json')
-        extract_script_path = os.path.join(BASE_DIR, 'extract_pdf_direct_enhanced.py')
+        success, _ = run_pipeline_step('extract_pdf_direct_enhanced.py', run_extract_items,
+                                       timeout=300, log_name='requote.extract_items')
         
-        result = subprocess.run(
-            ['python', extract_script_path],
-            capture_output=True,
-            text=True,
-            cwd=BASE_DIR,
-            timeout=300
-        )
-        
-        if result.returncode != 0 or not os.path.exists(items_output_path):
+        if not success or not os.path.exists(items_output_path):
             with _status_lock:
                 processing_status['status'] = 'error'
                 processing_status['message'] = 'Extraction failed'
             return
         
-        with open(items_output_path, 'r', encoding='utf-8') as f:
-            full_data = json.load(f)
+        with open(items_output_path, 'rb') as f:
+            full_data = orjson.loads(f.read())
         
         items = full_data.get('items', [])
         
@@ -417,24 +545,12 @@ def api_upload_offer2():
         # Extract company data from template
         print("Extracting company data from template...", flush=True)
         
-        extract_script_path = os.path.join(BASE_DIR, 'extract_company_data.py')
-        
-        result = subprocess.run(
-            ['python', extract_script_path],
-            capture_output=True,
-            text=True,
-            cwd=BASE_DIR,
-            timeout=180
-        )
-        
-        if result.stdout:
-            print(result.stdout, flush=True)
-        if result.stderr:
-            print(result.stderr, flush=True)
+        success, _ = run_pipeline_step('extract_company_data.py', run_extract_company_data,
+                                       timeout=180, log_name='requote.extract_company_data')
         
         company_data_path = os.path.join(OUTPUT_FOLDER, 'company_data.json')
         
-        if result.returncode != 0 or not os.path.exists(company_data_path):
+        if not success or not os.path.exists(company_data_path):
             print("⚠ Company extraction had issues, but continuing...", flush=True)
             # Don't fail - we can still generate basic offer
         else:
@@ -476,15 +592,15 @@ def api_generate_offer():
         # Apply markup if needed
         if markup > 0:
             print(f"Applying {markup}% markup...", flush=True)
-            with open(items_path, 'r', encoding='utf-8') as f:
-                full_data = json.load(f)
+            with open(items_path, 'rb') as f:
+                full_data = orjson.loads(f.read())
             
             items = full_data.get('items', [])
             items = apply_markup_to_items(items, markup)
             full_data['items'] = items
             
-            with open(items_path, 'w', encoding='utf-8') as f:
-                json.dump(full_data, f, ensure_ascii=False, indent=2)
+            with open(items_path, 'wb') as f:
+                f.write(orjson.dumps(full_data, option=orjson.OPT_INDENT_2))
         
         # Clean up old output files
         old_offer3 = os.path.join(OUTPUT_FOLDER, 'final_offer3.docx')
@@ -497,25 +613,13 @@ def api_generate_offer():
         
         # Generate using NEW build_offer3.py script
         print("Building Offer 3 from scratch...", flush=True)
-        build_script_path = os.path.join(BASE_DIR, 'build_offer3.py')
+        success, details = run_pipeline_step('build_offer3.py', run_build_offer3,
+                                             timeout=120, log_name='requote.build_offer3')
         
-        result = subprocess.run(
-            ['python', build_script_path],
-            capture_output=True,
-            text=True,
-            cwd=BASE_DIR,
-            timeout=120
-        )
-        
-        if result.stdout:
-            print(result.stdout, flush=True)
-        if result.stderr:
-            print(result.stderr, flush=True)
-        
-        if result.returncode != 0:
+        if not success:
             return jsonify({
                 'error': 'Offer generation failed',
-                'details': result.stderr
+                'details': details
             }), 500
         
         output_path = os.path.join(OUTPUT_FOLDER, 'final_offer3.docx')
@@ -523,8 +627,8 @@ def api_generate_offer():
         if not os.path.exists(output_path):
             return jsonify({'error': 'Output file not generated'}), 500
         
-        with open(items_path, 'r', encoding='utf-8') as f:
-            full_data = json.load(f)
+        with open(items_path, 'rb') as f:
+            full_data = orjson.loads(f.read())
             items = full_data.get('items', [])
         
         print(f"✓ Offer 3 generated successfully", flush=True)
@@ -572,22 +676,18 @@ def api_download_offer():
         if output_path.endswith('.xlsx'):
             mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
         
-        from flask import Response
-        
-        with open(output_path, 'rb') as f:
-            file_data = f.read()
-        
-        response = Response(
-            file_data,
+        # Stream the file from disk rather than reading it into memory first
+        response = send_file(
+            output_path,
             mimetype=mimetype,
-            headers={
-                'Content-Disposition': f'attachment; filename="{download_name}"',
-                'Content-Type': mimetype,
-                'Cache-Control': 'no-cache',
-                'Pragma': 'no-cache',
-                'Expires': '0'
-            }
+            as_attachment=True,
+            download_name=download_name,
+            conditional=False,
+            etag=False
         )
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
         
         return response
         
@@ -595,20 +695,32 @@ def api_download_offer():
         print(f"Error in download-offer: {str(e)}", flush=True)
         return jsonify({'error': str(e)}), 500
 
-def apply_markup_to_items(items, markup_percent):
-    import re
+PRICE_NUMBER_RE = re.compile(r'\d+\.?\d*')
+CURRENCY_RE = re.compile(r'[€$£¥]')
+
+@lru_cache(maxsize=256)
+def parse_price(price_str):
+    """
+    Return (amount, currency_symbol) for a price string, or None if it has
+    no number. Cached: offers repeat the same price strings across items
+    """
+    number = PRICE_NUMBER_RE.search(price_str)
+    if not number:
+        return None
     
+    currency = CURRENCY_RE.search(price_str)
+    return float(number.group()), currency.group() if currency else '€'
+
+def apply_markup_to_items(items, markup_percent):
     for item in items:
         price_str = str(item.get('unit_price', ''))
         if not price_str or price_str == '':
             price_str = str(item.get('price', ''))
         
-        numbers = re.findall(r'\d+\.?\d*', price_str)
-        if numbers:
-            original_price = float(numbers[0])
+        parsed = parse_price(price_str)
+        if parsed:
+            original_price, currency_symbol = parsed
             new_price = original_price * (1 + markup_percent / 100)
-            currency = re.findall(r'[€$£¥]', price_str)
-            currency_symbol = currency[0] if currency else '€'
             item['unit_price'] = currency_symbol + str(round(new_price, 2))
             if 'price' in item:
                 item['price'] = currency_symbol + str(round(new_price, 2))
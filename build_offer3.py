@@ -5,17 +5,32 @@ Reads content_blocks from JSON and rebuilds with tables, bullets, formatting
 
 import os
 import sys
-import json
-import shutil
+import orjson
+from io import BytesIO
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta
 from docx import Document
 from docx.shared import Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml.ns import qn
 from standard_template import Offer3Template
+from pipeline_common import buffered_logger, flush_log, StepCancelled, check_cancelled
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_FOLDER = os.path.join(BASE_DIR, 'outputs')
 
+# Longest paragraph block copied into the offer (keeps the .docx small)
+MAX_PARAGRAPH_CHARS = 8000
+
+# Font sizes and tag names used in the per-block loops, built once
+PT11, PT12, PT14 = Pt(11), Pt(12), Pt(14)
+W_P, W_TBL = qn('w:p'), qn('w:tbl')
+
+# Progress output is buffered (see pipeline_common.buffered_logger)
+log = buffered_logger('requote.build_offer3')
+
 def add_structured_content_to_doc(doc, items):
     """
     Add technical content with PRESERVED STRUCTURE from content_blocks
@@ -24,7 +39,7 @@ def add_structured_content_to_doc(doc, items):
     # Section heading
     heading = doc.add_paragraph()
     run = heading.add_run("Technical Specifications")
-    run.font.size = Pt(14)
+    run.font.size = PT14
     run.font.bold = True
     
     doc.add_paragraph()  # Spacing
@@ -40,7 +55,7 @@ def add_structured_content_to_doc(doc, items):
         # Item heading
         item_heading = doc.add_paragraph()
         run = item_heading.add_run(f"{item['item_number']}. {item['item_name']}")
-        run.font.size = Pt(12)
+        run.font.size = PT12
         run.font.bold = True
         
         # Rebuild content with structure
@@ -58,82 +73,111 @@ def add_structured_content_to_doc(doc, items):
                 num_cols = len(table_data[0]) if table_data else 0
                 
                 if num_rows > 0 and num_cols > 0:
-                    table = doc.add_table(rows=num_rows, cols=num_cols)
+                    table = doc.add_table(rows=1, cols=num_cols)
                     table.style = 'Light Grid Accent 1'
                     
-                    for row_idx, row_data in enumerate(table_data):
-                        for col_idx, cell_text in enumerate(row_data):
-                            if col_idx < num_cols:
-                                cell_value = str(cell_text) if cell_text is not None else ''
-                                table.rows[row_idx].cells[col_idx].text = cell_value
+                    # Clone one empty <w:tr> per row and write each value
+                    # as a run into the cell's (empty) paragraph - no
+                    # table.rows[i].cells[j] or _Cell.text proxies
+                    tbl = table._tbl
+                    row_template = tbl.tr_lst[0]
+                    tbl.remove(row_template)
+                    
+                    for row_data in table_data:
+                        tr = deepcopy(row_template)
+                        for tc, cell_text in zip(tr.tc_lst, row_data):
+                            if cell_text is not None and cell_text != '':
+                                tc.p_lst[0].add_r().text = str(cell_text)
+                        tbl.append(tr)
             
             elif block_type == 'bullet':
                 # Bullet point
                 para = doc.add_paragraph(style='List Bullet')
                 run = para.add_run(block.get('text', ''))
-                run.font.size = Pt(11)
+                run.font.size = PT11
             
             elif block_type == 'numbered_list':
                 # Numbered list
                 para = doc.add_paragraph(style='List Number')
                 run = para.add_run(block.get('text', ''))
-                run.font.size = Pt(11)
+                run.font.size = PT11
             
             elif block_type == 'heading':
                 # Sub-heading
                 para = doc.add_paragraph()
                 run = para.add_run(block.get('text', ''))
-                run.font.size = Pt(11)
+                run.font.size = PT11
                 run.font.bold = True
             
             else:
-                # Normal paragraph
+                # Normal paragraph - capped, one Word paragraph per text block
                 text = block.get('text', '')
-                if text.strip():
-                    para = doc.add_paragraph()
-                    run = para.add_run(text)
-                    run.font.size = Pt(11)
+                if len(text) > MAX_PARAGRAPH_CHARS:
+                    text = text[:MAX_PARAGRAPH_CHARS] + ' […truncated]'
+                
+                for chunk in text.split('\n\n'):
+                    if chunk.strip():
+                        para = doc.add_paragraph()
+                        run = para.add_run(chunk)
+                        run.font.size = PT11
         
         doc.add_paragraph()  # Spacing between items
         items_added += 1
     
-    print(f"  ✓ Added structured content for {items_added} items", flush=True)
+    log.info(f"  ✓ Added structured content for {items_added} items")
 
-def generate_offer3(company_data_path, items_data_path, output_path):
+def load_json_file(path):
+    """Read and parse a JSON file"""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+@lru_cache(maxsize=4)
+def load_template_bytes(path, mtime_ns):
+    """Read the template file; cached per path and modification time"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def open_template(path):
     """
-    Build Offer 3 using structured content from extraction
+    Parse the template from its cached bytes, so repeated in-process runs
+    skip the disk read (an edited template has a new mtime and is re-read)
+    """
+    return Document(BytesIO(load_template_bytes(path, os.stat(path).st_mtime_ns)))
+
+def save_document_atomic(doc, output_path):
+    """
+    Serialize the document in memory, write it with a single write + fsync
+    and rename it into place, so a failed run never leaves a partial .docx
+    """
+    buffer = BytesIO()
+    doc.save(buffer)
+    
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer.getbuffer())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path)
+
+def generate_offer3(company_data_path, items_data_path, output_path, cancel=None):
+    """
+    Build Offer 3 using structured content from extraction.
+    cancel: optional threading.Event; once set, the run stops before the
+    document is saved
     """
     
     try:
-        print("=" * 60, flush=True)
-        print("BUILDING OFFER 3 - STRUCTURE PRESERVED", flush=True)
-        print("=" * 60, flush=True)
+        log.info("=" * 60)
+        log.info("BUILDING OFFER 3 - STRUCTURE PRESERVED")
+        log.info("=" * 60)
         
-        # Load items data
-        print(f"Loading items data: {items_data_path}", flush=True)
+        # Check inputs
+        log.info(f"Loading items data: {items_data_path}")
         if not os.path.exists(items_data_path):
-            print("✗ Items data not found!", flush=True)
+            log.error("✗ Items data not found!")
             return False
         
-        with open(items_data_path, 'r', encoding='utf-8') as f:
-            items_data = json.load(f)
-        
-        items = items_data.get('items', [])
-        print(f"✓ Loaded {len(items)} items", flush=True)
-        
-        # Check structure preservation
-        items_with_blocks = sum(1 for item in items if item.get('content_blocks'))
-        total_blocks = sum(len(item.get('content_blocks', [])) for item in items)
-        
-        print(f"  Items with structured content: {items_with_blocks}/{len(items)}", flush=True)
-        print(f"  Total content blocks: {total_blocks}", flush=True)
-        
-        # Load company data (optional)
-        company_data = {}
-        if os.path.exists(company_data_path):
-            with open(company_data_path, 'r', encoding='utf-8') as f:
-                company_data = json.load(f)
-        
         # Find template file
         template_path_options = [
             os.path.join(BASE_DIR, 'offer2_template.docx'),
@@ -144,38 +188,52 @@ def generate_offer3(company_data_path, items_data_path, output_path):
         for path in template_path_options:
             if os.path.exists(path):
                 template_path = path
-                print(f"✓ Found template: {path}", flush=True)
+                log.info(f"✓ Found template: {path}")
                 break
         
         if not template_path:
-            print("✗ Template not found!", flush=True)
+            log.error("✗ Template not found!")
             return False
         
-        # Copy template to output
-        print(f"Copying template to: {output_path}", flush=True)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        shutil.copy2(template_path, output_path)
-        print("✓ Template copied", flush=True)
+        # Items, company data (optional) and the template are independent
+        # files - read and parse them concurrently. The template is opened
+        # from memory (see open_template); output_path is only written once
+        # the finished document is saved (see save_document_atomic)
+        log.info("Opening template...")
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            items_future = pool.submit(load_json_file, items_data_path)
+            company_future = None
+            if os.path.exists(company_data_path):
+                company_future = pool.submit(load_json_file, company_data_path)
+            doc_future = pool.submit(open_template, template_path)
+            
+            items_data = items_future.result()
+            company_data = company_future.result() if company_future else {}
+            doc = doc_future.result()
         
-        # Open the copied template
-        print("Opening copied template...", flush=True)
-        doc = Document(output_path)
+        items = items_data.get('items', [])
+        log.info(f"✓ Loaded {len(items)} items")
         
-        # Clear body content (keep header/footer)
-        print("Clearing body content...", flush=True)
+        # Check structure preservation
+        items_with_blocks = sum(1 for item in items if item.get('content_blocks'))
+        total_blocks = sum(len(item.get('content_blocks', [])) for item in items)
+        
+        log.info(f"  Items with structured content: {items_with_blocks}/{len(items)}")
+        log.info(f"  Total content blocks: {total_blocks}")
         
-        for para in doc.paragraphs[:]:
-            p_element = para._element
-            p_element.getparent().remove(p_element)
+        # Clear body content (keep header/footer)
+        log.info("Clearing body content...")
         
-        for table in doc.tables[:]:
-            t_element = table._element
-            t_element.getparent().remove(t_element)
+        # One pass over the body's children, no python-docx proxy objects
+        body = doc.element.body
+        for element in list(body):
+            if element.tag in (W_P, W_TBL):
+                body.remove(element)
         
-        print("✓ Body content cleared", flush=True)
+        log.info("✓ Body content cleared")
         
         # Add new content
-        print("\nAdding new content...", flush=True)
+        log.info("\nAdding new content...")
         
         # Generate metadata
         today = datetime.now()
@@ -188,51 +246,65 @@ def generate_offer3(company_data_path, items_data_path, output_path):
         template_helper.doc = doc
         
         # 1. Document info
-        print("  → Adding document info...", flush=True)
+        log.info("  → Adding document info...")
         template_helper.add_document_info_table(quote_number, quote_date, valid_until, "[Customer Name]")
         
         # 2. Pricing table
-        print("  → Adding pricing table...", flush=True)
+        log.info("  → Adding pricing table...")
         template_helper.add_pricing_table(items)
         
         # 3. Technical content with STRUCTURE
-        print("  → Adding structured technical content...", flush=True)
-        add_structured_content_to_doc(doc, items)
+        # Only items with content_blocks produce output here, so skip the
+        # section (and its heading) entirely when the extraction has none
+        if items_with_blocks:
+            log.info("  → Adding structured technical content...")
+            add_structured_content_to_doc(doc, items)
+        else:
+            log.info("  → No structured technical content, section skipped")
         
         # 4. Commercial terms
-        print("  → Adding commercial terms...", flush=True)
+        log.info("  → Adding commercial terms...")
         template_helper.add_commercial_terms(company_data)
         
         # Save
-        print(f"\nSaving document: {output_path}", flush=True)
-        doc.save(output_path)
+        check_cancelled(cancel)
+        log.info(f"\nSaving document: {output_path}")
+        save_document_atomic(doc, output_path)
         
         file_size = os.path.getsize(output_path)
-        print(f"✓ Document saved: {file_size:,} bytes", flush=True)
+        log.info(f"✓ Document saved: {file_size:,} bytes")
         
         # Summary
-        print("\n" + "=" * 60, flush=True)
-        print("OFFER 3 GENERATION SUMMARY", flush=True)
-        print("=" * 60, flush=True)
-        print(f"Total Items: {len(items)}", flush=True)
-        print(f"Items with structured content: {items_with_blocks}", flush=True)
-        print(f"Total content blocks: {total_blocks}", flush=True)
-        print(f"Quote Number: {quote_number}", flush=True)
-        print(f"Valid Until: {valid_until}", flush=True)
-        print("=" * 60, flush=True)
-        
-        print("\n✓ OFFER 3 GENERATION COMPLETED SUCCESSFULLY", flush=True)
+        log.info("\n" + "=" * 60)
+        log.info("OFFER 3 GENERATION SUMMARY")
+        log.info("=" * 60)
+        log.info(f"Total Items: {len(items)}")
+        log.info(f"Items with structured content: {items_with_blocks}")
+        log.info(f"Total content blocks: {total_blocks}")
+        log.info(f"Quote Number: {quote_number}")
+        log.info(f"Valid Until: {valid_until}")
+        log.info("=" * 60)
+        
+        log.info("\n✓ OFFER 3 GENERATION COMPLETED SUCCESSFULLY")
         
         return True
         
+    except StepCancelled as e:
+        log.error(f"\n✗ {str(e)}, no output written")
+        return False
+    
     except Exception as e:
-        print(f"\n✗ FATAL ERROR: {str(e)}", flush=True)
+        log.error(f"\n✗ FATAL ERROR: {str(e)}")
         import traceback
         traceback.print_exc()
         return False
+    
+    finally:
+        # Called in-process by the API: write out what is still buffered
+        flush_log(log)
 
 if __name__ == "__main__":
-    print("Offer 3 Generation Script Started", flush=True)
+    log.info("Offer 3 Generation Script Started")
     
     company_data_path = os.path.join(OUTPUT_FOLDER, "company_data.json")
     items_data_path = os.path.join(OUTPUT_FOLDER, "items_offer1.json")
@@ -241,8 +313,8 @@ if __name__ == "__main__":
     success = generate_offer3(company_data_path, items_data_path, output_path)
     
     if not success:
-        print("✗ Generation failed", flush=True)
+        log.error("✗ Generation failed")
         sys.exit(1)
     
-    print("✓ COMPLETED SUCCESSFULLY", flush=True)
+    log.info("✓ COMPLETED SUCCESSFULLY")
     sys.exit(0)
\ No newline at end of file
@@ -7,8 +7,26 @@ Just copy the paragraphs, tables, and images AS-IS
 import os
 from docx import Document
 from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
 from copy import deepcopy
 
+COPIED_TAGS = (qn('w:p'), qn('w:tbl'))
+
+def insert_body_elements(target_doc, elements):
+    """
+    Insert copies of body elements into target_doc in one splice, before
+    the final sectPr (instead of one add_paragraph/append per element)
+    """
+    body = target_doc.element.body
+    copies = [deepcopy(element) for element in elements]
+    
+    sect_pr = body.sectPr
+    index = body.index(sect_pr) if sect_pr is not None else len(body)
+    body[index:index] = copies
+    
+    return len(copies)
+
 def copy_technical_content_from_offer1(offer1_path, target_doc, start_after_keyword="TECHNICAL SPECIFICATIONS"):
     """
     Copy ALL content after a keyword from Offer 1 directly to target document
@@ -26,59 +44,30 @@ def copy_technical_content_from_offer1(offer1_path, target_doc, start_after_keyw
     try:
         source_doc = Document(offer1_path)
         
-        # Find where technical content starts
-        start_copying = False
-        start_index = None
-        
-        for i, para in enumerate(source_doc.paragraphs):
-            if start_after_keyword.lower() in para.text.lower():
-                start_copying = True
-                start_index = i
-                print(f"✓ Found keyword at paragraph {i}: '{para.text[:50]}'")
-                break
-        
-        if not start_copying:
-            print(f"⚠ Keyword '{start_after_keyword}' not found, copying all content")
-            start_index = 0
-        
-        # Get all body elements (paragraphs AND tables in correct order)
-        body_elements = source_doc.element.body
-        
-        # Track element index properly
-        current_element_index = 0
+        # Single pass over body elements (paragraphs AND tables in order):
+        # locate the keyword paragraph directly by its element index
+        body_elements = list(source_doc.element.body)
+        keyword = start_after_keyword.lower()
         start_element_index = None
-        elements_copied = 0
         
-        # FIRST PASS: Find which ELEMENT index corresponds to the paragraph index
-        para_counter = 0
         for idx, element in enumerate(body_elements):
-            if element.tag.endswith('p'):
-                if para_counter == start_index:
+            if element.tag == qn('w:p'):
+                para_text = Paragraph(element, source_doc._body).text
+                if keyword in para_text.lower():
                     start_element_index = idx
-                    print(f"✓ Start copying from element index {idx} (paragraph {start_index})", flush=True)
+                    print(f"✓ Found keyword at element {idx}: '{para_text[:50]}'")
                     break
-                para_counter += 1
         
         if start_element_index is None:
-            print(f"⚠ Could not find element index for paragraph {start_index}", flush=True)
+            print(f"⚠ Keyword '{start_after_keyword}' not found, copying all content")
             start_element_index = 0
         
-        # SECOND PASS: Copy all elements from start_element_index onwards
+        # Copy all elements from start_element_index onwards
         print(f"Copying elements from index {start_element_index} to end...", flush=True)
-        
-        for idx, element in enumerate(body_elements):
-            if idx >= start_element_index:
-                # Copy paragraph
-                if element.tag.endswith('p'):
-                    new_para = target_doc.add_paragraph()
-                    new_para._element = deepcopy(element)
-                    elements_copied += 1
-                
-                # Copy table
-                elif element.tag.endswith('tbl'):
-                    new_table_element = deepcopy(element)
-                    target_doc.element.body.append(new_table_element)
-                    elements_copied += 1
+        elements_copied = insert_body_elements(target_doc, [
+            element for element in body_elements[start_element_index:]
+            if element.tag in COPIED_TAGS
+        ])
         
         print(f"✓ Copied {elements_copied} elements (paragraphs + tables)")
         return True
@@ -134,21 +123,19 @@ def copy_section_from_document(source_path, target_doc, start_keyword, end_keywo
         # Copy elements in range
         body_elements = source_doc.element.body
         para_counter = 0
-        elements_copied = 0
+        selected = []
         
         for element in body_elements:
-            if element.tag.endswith('p'):
+            if element.tag == qn('w:p'):
                 if start_idx <= para_counter < end_idx:
-                    new_para = target_doc.add_paragraph()
-                    new_para._element = deepcopy(element)
-                    elements_copied += 1
+                    selected.append(element)
                 para_counter += 1
             
-            elif element.tag.endswith('tbl'):
+            elif element.tag == qn('w:tbl'):
                 if start_idx <= para_counter < end_idx:
-                    new_table_element = deepcopy(element)
-                    target_doc.element.body.append(new_table_element)
-                    elements_copied += 1
+                    selected.append(element)
+        
+        elements_copied = insert_body_elements(target_doc, selected)
         
         print(f"✓ Copied {elements_copied} elements")
         return True
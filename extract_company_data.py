@@ -1,24 +1,113 @@
 import os
 import sys
-import json
+import orjson
+import time
+import hashlib
 import openai
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from docx import Document
 from PIL import Image
 import io
+from pipeline_common import (MAX_RETRIES, RETRYABLE_ERRORS, retry_delay,
+                             share_openai_session, buffered_logger, flush_log,
+                             StepCancelled, check_cancelled)
 
 openai.api_key = os.environ.get('OPENAI_API_KEY')
+share_openai_session()
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 OUTPUT_FOLDER = os.path.join(BASE_DIR, 'outputs')
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-def extract_logo_from_docx(docx_path):
-    """Extract logo image from DOCX header/body"""
+# Progress output is buffered (see pipeline_common.buffered_logger)
+log = buffered_logger('requote.extract_company_data')
+
+# GPT results are cached per template; bump the version when the prompt or
+# model changes, set REQUOTE_NO_CACHE=1 to always call the API
+COMPANY_PROMPT_VERSION = "4"
+COMPANY_CACHE_DIR = os.path.join(OUTPUT_FOLDER, 'company_cache')
+COMPANY_CACHE_TTL_SECONDS = 30 * 24 * 3600
+COMPANY_CACHE_DISABLED = os.environ.get('REQUOTE_NO_CACHE', '').lower() in ('1', 'true', 'yes')
+
+# The filled-in company object is a few hundred tokens
+COMPANY_MAX_TOKENS = 1000
+
+# Each API request is bounded; retries follow the shared policy in
+# pipeline_common
+REQUEST_TIMEOUT = 30
+
+def _string_fields(*names):
+    return {name: {"type": "string"} for name in names}
+
+def _strict_object(properties):
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+# Structured output: the API only returns objects matching this schema
+COMPANY_DATA_SCHEMA = {
+    "name": "company_data",
+    "strict": True,
+    "schema": _strict_object({
+        **_string_fields("company_name", "address", "phone", "email", "website", "tax_id", "registration_no"),
+        "bank_details": _strict_object(_string_fields("bank_name", "iban", "swift", "account_holder")),
+        "standard_terms": _strict_object(_string_fields("delivery", "payment", "warranty")),
+        **_string_fields("legal_info")
+    })
+}
+
+# Static instructions first, template text last: repeated calls share a
+# byte-identical prompt prefix (server-side prompt caching)
+COMPANY_PROMPT = """Extract company information from this quotation template.
+
+CRITICAL: Extract information about the COMPANY who owns this template (the seller/quotation creator), NOT about products or customers mentioned in the template.
+
+Look for these patterns:
+- Company name: Usually at the top, in headers, or in footer
+- Address: Street, city, postal code, country
+- Contact: Phone numbers (with country code like +XX), email addresses, website URLs
+- Legal info: VAT number, Tax ID, Registration number
+- Bank details: IBAN, SWIFT/BIC code, bank name, account holder
+- Commercial terms: Delivery timeframes (e.g., "14 working weeks"), payment terms (e.g., "30% advance"), warranty terms
+
+Return JSON:
+{
+  "company_name": "Full legal company name",
+  "address": "Complete address with city and country",
+  "phone": "Phone number with country code",
+  "email": "Email address",
+  "website": "Website URL",
+  "tax_id": "VAT or Tax ID number",
+  "registration_no": "Company registration number",
+  "bank_details": {
+    "bank_name": "Name of the bank",
+    "iban": "IBAN number",
+    "swift": "SWIFT/BIC code",
+    "account_holder": "Account holder name"
+  },
+  "standard_terms": {
+    "delivery": "Delivery timeframe or terms",
+    "payment": "Payment terms and conditions",
+    "warranty": "Warranty terms"
+  },
+  "legal_info": "Any additional legal information, registration details, or certifications"
+}
+
+If a field is not found in the template, use empty string "".
+"""
+
+COMPANY_PROMPT_CONTENT = """
+Template content:
+"""
+
+def extract_logo_from_docx(doc):
+    """Extract logo image from an opened DOCX (header/body images)"""
     try:
-        doc = Document(docx_path)
-        
         # Check for images in document
         images = []
         image_index = 0
@@ -49,45 +138,166 @@ def extract_logo_from_docx(docx_path):
         
         if images:
             # Return first image (usually the logo)
-            print(f"✓ Found {len(images)} image(s) in document", flush=True)
+            log.info(f"✓ Found {len(images)} image(s) in document")
             return images[0]
         else:
-            print("⚠ No logo image found in document", flush=True)
+            log.warning("⚠ No logo image found in document")
             return None
             
     except Exception as e:
-        print(f"✗ Logo extraction failed: {str(e)}", flush=True)
+        log.error(f"✗ Logo extraction failed: {str(e)}")
         return None
 
-def extract_company_data_from_offer2(offer2_path, output_path):
-    """Extract company branding and information from Offer 2 template"""
+def empty_company_data():
+    """Company data structure with every field blank"""
+    return {
+        "company_name": "",
+        "address": "",
+        "phone": "",
+        "email": "",
+        "website": "",
+        "tax_id": "",
+        "registration_no": "",
+        "bank_details": {
+            "bank_name": "",
+            "iban": "",
+            "swift": "",
+            "account_holder": ""
+        },
+        "standard_terms": {
+            "delivery": "",
+            "payment": "",
+            "warranty": ""
+        },
+        "legal_info": "",
+        "logo": None
+    }
+
+def company_cache_key(prompt_text):
+    """
+    SHA-256 of the normalized template text sent to GPT plus the prompt
+    version - the response depends on nothing else, so re-saved or
+    re-exported templates with the same content still hit the cache
+    """
+    digest = hashlib.sha256(prompt_text.encode('utf-8'))
+    digest.update(f"|{COMPANY_PROMPT_VERSION}".encode('utf-8'))
+    return digest.hexdigest()
+
+def load_cached_company_data(cache_key, max_age=COMPANY_CACHE_TTL_SECONDS):
+    """
+    Return the cached GPT result for a template, or None on miss/expiry
+    (max_age=None accepts expired entries)
+    """
+    if COMPANY_CACHE_DISABLED:
+        return None
     
+    cache_path = os.path.join(COMPANY_CACHE_DIR, f"{cache_key}.json")
     try:
-        print("=" * 60, flush=True)
-        print("EXTRACTING COMPANY DATA FROM OFFER 2", flush=True)
-        print("=" * 60, flush=True)
+        if max_age is not None and time.time() - os.path.getmtime(cache_path) > max_age:
+            return None
+        with open(cache_path, 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def save_cached_company_data(cache_key, company_data):
+    """Write the GPT result to the cache (atomically, via rename)"""
+    if COMPANY_CACHE_DISABLED:
+        return
+    
+    os.makedirs(COMPANY_CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(COMPANY_CACHE_DIR, f"{cache_key}.json")
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(company_data))
+    os.replace(tmp_path, cache_path)
+
+def request_company_data(prompt_text):
+    """Ask GPT-4o for the company fields found in the template text"""
+    
+    log.info("Calling GPT-4o for company data extraction...")
+    flush_log(log)
+    
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = openai.ChatCompletion.create(
+                model="gpt-4o",
+                messages=[{
+                    "role": "system",
+                    "content": "Output only a single JSON object. No prose, no markdown."
+                }, {
+                    "role": "user",
+                    "content": "".join((COMPANY_PROMPT, COMPANY_PROMPT_CONTENT, prompt_text))
+                }],
+                max_tokens=COMPANY_MAX_TOKENS,
+                temperature=0,
+                response_format={"type": "json_schema", "json_schema": COMPANY_DATA_SCHEMA},
+                request_timeout=REQUEST_TIMEOUT,
+                stream=True
+            )
+            return read_company_stream(response)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = retry_delay(e, attempt)
+            log.warning(f"⚠ OpenAI request failed ({e}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+def read_company_stream(response):
+    """
+    Collect streamed deltas and parse as soon as they form the complete
+    (schema-constrained, bare) JSON object, without waiting for the end
+    of the stream
+    """
+    pieces = []
+    
+    for chunk in response:
+        text = chunk['choices'][0]['delta'].get('content') or ''
+        pieces.append(text)
+        
+        if text.rstrip().endswith('}'):
+            try:
+                company_data = orjson.loads("".join(pieces))
+            except ValueError:
+                continue  # closed a nested object, keep reading
+            log.info("Received response from GPT-4o")
+            return company_data
+    
+    log.info("Received response from GPT-4o")
+    return orjson.loads("".join(pieces))
+
+def extract_company_data_from_offer2(offer2_path, output_path, cancel=None):
+    """
+    Extract company branding and information from Offer 2 template.
+    cancel: optional threading.Event; once set, the run stops before
+    writing any output
+    """
+    
+    try:
+        log.info("=" * 60)
+        log.info("EXTRACTING COMPANY DATA FROM OFFER 2")
+        log.info("=" * 60)
         
         if not openai.api_key:
-            print("✗ OPENAI_API_KEY not set", flush=True)
+            log.error("✗ OPENAI_API_KEY not set")
             return False
         
-        print(f"Reading template: {offer2_path}", flush=True)
+        log.info(f"Reading template: {offer2_path}")
         
         if not os.path.exists(offer2_path):
-            print("✗ Template file not found", flush=True)
+            log.error("✗ Template file not found")
             return False
         
-        # Extract logo image FIRST
-        logo_data = extract_logo_from_docx(offer2_path)
+        # Parse the template once for both the logo and the text
+        doc = Document(offer2_path)
         
         # Read DOCX content comprehensively (headers, footers, body, tables)
-        print("Reading DOCX content comprehensively...", flush=True)
-        doc = Document(offer2_path)
+        log.info("Reading DOCX content comprehensively...")
         
         text_content = []
         
         # 1. HEADERS (most common location for company logo/info)
-        print("Extracting from headers...", flush=True)
+        log.info("Extracting from headers...")
         header_texts = []
         for section in doc.sections:
             if section.header:
@@ -104,33 +314,33 @@ def extract_company_data_from_offer2(offer2_path, output_path):
                             header_texts.append(row_text)
         
         if header_texts:
-            print(f"✓ Found {len(header_texts)} items in headers", flush=True)
+            log.info(f"✓ Found {len(header_texts)} items in headers")
             text_content.extend(header_texts)
         
         # 2. FIRST PAGE / TITLE PAGE (first 20 paragraphs)
-        print("Extracting from first page/title page...", flush=True)
+        log.info("Extracting from first page/title page...")
         first_page_texts = []
         for para in doc.paragraphs[:20]:
             if para.text.strip():
                 first_page_texts.append(para.text.strip())
         
         if first_page_texts:
-            print(f"✓ Found {len(first_page_texts)} paragraphs on first page", flush=True)
+            log.info(f"✓ Found {len(first_page_texts)} paragraphs on first page")
             text_content.extend(first_page_texts)
         
         # 3. BODY PARAGRAPHS (next 30 paragraphs after first 20)
-        print("Extracting from body paragraphs...", flush=True)
+        log.info("Extracting from body paragraphs...")
         body_texts = []
         for para in doc.paragraphs[20:50]:
             if para.text.strip():
                 body_texts.append(para.text.strip())
         
         if body_texts:
-            print(f"✓ Found {len(body_texts)} paragraphs in body", flush=True)
+            log.info(f"✓ Found {len(body_texts)} paragraphs in body")
             text_content.extend(body_texts)
         
         # 4. TABLES (first 10 tables - company info sometimes in tables)
-        print("Extracting from tables...", flush=True)
+        log.info("Extracting from tables...")
         table_texts = []
         for table_idx, table in enumerate(doc.tables[:10]):
             for row in table.rows:
@@ -139,11 +349,11 @@ def extract_company_data_from_offer2(offer2_path, output_path):
                     table_texts.append(row_text)
         
         if table_texts:
-            print(f"✓ Found {len(table_texts)} table rows", flush=True)
+            log.info(f"✓ Found {len(table_texts)} table rows")
             text_content.extend(table_texts)
         
         # 5. FOOTERS (bank details, legal info often here)
-        print("Extracting from footers...", flush=True)
+        log.info("Extracting from footers...")
         footer_texts = []
         for section in doc.sections:
             if section.footer:
@@ -160,183 +370,152 @@ def extract_company_data_from_offer2(offer2_path, output_path):
                             footer_texts.append(row_text)
         
         if footer_texts:
-            print(f"✓ Found {len(footer_texts)} items in footers", flush=True)
+            log.info(f"✓ Found {len(footer_texts)} items in footers")
             text_content.extend(footer_texts)
         
-        combined_text = "\n".join(text_content)
-        
-        print(f"Extracted {len(combined_text)} characters of text", flush=True)
-        print(f"Sample text: {combined_text[:200]}...", flush=True)
-        
-        # Use GPT-4o for extraction with enhanced prompt
-        print("Calling GPT-4o for company data extraction...", flush=True)
-        
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[{
-                "role": "user",
-                "content": f"""Extract company information from this quotation template.
-
-CRITICAL: Extract information about the COMPANY who owns this template (the seller/quotation creator), NOT about products or customers mentioned in the template.
-
-Look for these patterns:
-- Company name: Usually at the top, in headers, or in footer
-- Address: Street, city, postal code, country
-- Contact: Phone numbers (with country code like +XX), email addresses, website URLs
-- Legal info: VAT number, Tax ID, Registration number
-- Bank details: IBAN, SWIFT/BIC code, bank name, account holder
-- Commercial terms: Delivery timeframes (e.g., "14 working weeks"), payment terms (e.g., "30% advance"), warranty terms
-
-Template content:
-{combined_text[:4000]}
-
-Return ONLY valid JSON (no markdown, no backticks):
-{{
-  "company_name": "Full legal company name",
-  "address": "Complete address with city and country",
-  "phone": "Phone number with country code",
-  "email": "Email address",
-  "website": "Website URL",
-  "tax_id": "VAT or Tax ID number",
-  "registration_no": "Company registration number",
-  "bank_details": {{
-    "bank_name": "Name of the bank",
-    "iban": "IBAN number",
-    "swift": "SWIFT/BIC code",
-    "account_holder": "Account holder name"
-  }},
-  "standard_terms": {{
-    "delivery": "Delivery timeframe or terms",
-    "payment": "Payment terms and conditions",
-    "warranty": "Warranty terms"
-  }},
-  "legal_info": "Any additional legal information, registration details, or certifications"
-}}
-
-If a field is not found in the template, use empty string "".
-"""
-            }],
-            max_tokens=2000,
-            temperature=0
-        )
-        
-        extracted_json = response.choices[0].message.content.strip()
-        
-        print("Received response from GPT-4o", flush=True)
-        
-        # Clean JSON formatting
-        if extracted_json.startswith("```json"):
-            extracted_json = extracted_json.replace("```json", "").replace("```", "").strip()
-        elif extracted_json.startswith("```"):
-            extracted_json = extracted_json.replace("```", "").strip()
-        
-        print("Parsing extracted data...", flush=True)
-        company_data = json.loads(extracted_json)
+        # Collapse whitespace and drop repeated lines (headers/footers repeat
+        # for every section) so the prompt budget only carries unique text
+        seen_lines = set()
+        unique_lines = []
+        for line in text_content:
+            line = " ".join(line.split())
+            if line and line not in seen_lines:
+                seen_lines.add(line)
+                unique_lines.append(line)
+        
+        combined_text = "\n".join(unique_lines)
+        
+        log.info(f"Extracted {len(combined_text)} characters of text")
+        log.info(f"Sample text: {combined_text[:200]}...")
+        
+        # Extract and encode the logo in the background while GPT is asked
+        # for the company fields. Started only now: reading headers and
+        # footers above can add parts to the document's relationships
+        logo_pool = ThreadPoolExecutor(max_workers=1)
+        logo_future = logo_pool.submit(extract_logo_from_docx, doc)
+        logo_pool.shutdown(wait=False)
+        
+        # GPT-4o extraction, skipped when the template has no text or a
+        # template with the same text content was seen before
+        prompt_text = combined_text[:4000]
+        cache_key = company_cache_key(prompt_text)
+        company_data = load_cached_company_data(cache_key)
+        
+        if not prompt_text:
+            # Nothing for GPT to read (e.g. image-only template)
+            log.warning("⚠ Template has no text, skipping GPT extraction")
+            company_data = empty_company_data()
+        elif company_data is not None:
+            log.info("✓ Using cached company data (template content unchanged)")
+        else:
+            try:
+                company_data = request_company_data(prompt_text)
+            except Exception as e:
+                # Prefer the last good result for this template, even if
+                # expired, over the empty fallback structure
+                company_data = load_cached_company_data(cache_key, max_age=None)
+                if company_data is None:
+                    raise
+                log.warning(f"⚠ Company data request failed ({str(e)}), using last good result")
+            else:
+                save_cached_company_data(cache_key, company_data)
+        
+        check_cancelled(cancel)
         
         # Add logo data if extracted
+        logo_data = logo_future.result()
         if logo_data:
             company_data['logo'] = {
                 'format': logo_data['format'],
                 'data': logo_data['data'],
                 'size': logo_data['size']
             }
-            print(f"✓ Logo included ({logo_data['size']} bytes, {logo_data['format']})", flush=True)
+            log.info(f"✓ Logo included ({logo_data['size']} bytes, {logo_data['format']})")
         else:
             company_data['logo'] = None
-            print("⚠ No logo found", flush=True)
+            log.warning("⚠ No logo found")
         
         # Validation and display
-        print("\n" + "=" * 60, flush=True)
-        print("EXTRACTED COMPANY DATA", flush=True)
-        print("=" * 60, flush=True)
-        print(f"Company: {company_data.get('company_name', 'N/A')}", flush=True)
-        print(f"Address: {company_data.get('address', 'N/A')[:80]}...", flush=True)
-        print(f"Phone: {company_data.get('phone', 'N/A')}", flush=True)
-        print(f"Email: {company_data.get('email', 'N/A')}", flush=True)
-        print(f"Website: {company_data.get('website', 'N/A')}", flush=True)
-        print(f"Tax ID: {company_data.get('tax_id', 'N/A')}", flush=True)
+        log.info("\n" + "=" * 60)
+        log.info("EXTRACTED COMPANY DATA")
+        log.info("=" * 60)
+        log.info(f"Company: {company_data.get('company_name', 'N/A')}")
+        log.info(f"Address: {company_data.get('address', 'N/A')[:80]}...")
+        log.info(f"Phone: {company_data.get('phone', 'N/A')}")
+        log.info(f"Email: {company_data.get('email', 'N/A')}")
+        log.info(f"Website: {company_data.get('website', 'N/A')}")
+        log.info(f"Tax ID: {company_data.get('tax_id', 'N/A')}")
         
         bank = company_data.get('bank_details', {})
-        print(f"Bank: {bank.get('bank_name', 'N/A')}", flush=True)
-        print(f"IBAN: {bank.get('iban', 'N/A')}", flush=True)
-        print(f"SWIFT: {bank.get('swift', 'N/A')}", flush=True)
+        log.info(f"Bank: {bank.get('bank_name', 'N/A')}")
+        log.info(f"IBAN: {bank.get('iban', 'N/A')}")
+        log.info(f"SWIFT: {bank.get('swift', 'N/A')}")
         
         terms = company_data.get('standard_terms', {})
-        print(f"Delivery: {terms.get('delivery', 'N/A')}", flush=True)
-        print(f"Payment: {terms.get('payment', 'N/A')}", flush=True)
-        print(f"Warranty: {terms.get('warranty', 'N/A')}", flush=True)
-        print("=" * 60, flush=True)
+        log.info(f"Delivery: {terms.get('delivery', 'N/A')}")
+        log.info(f"Payment: {terms.get('payment', 'N/A')}")
+        log.info(f"Warranty: {terms.get('warranty', 'N/A')}")
+        log.info("=" * 60)
         
         # Validate that we got at least company name
         if not company_data.get('company_name') or company_data.get('company_name') == '':
-            print("⚠ WARNING: Company name not extracted. Extraction may have failed.", flush=True)
-            print("⚠ Saving partial data anyway...", flush=True)
+            log.warning("⚠ WARNING: Company name not extracted. Extraction may have failed.")
+            log.warning("⚠ Saving partial data anyway...")
         
         # Save to JSON
+        check_cancelled(cancel)
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(company_data, f, indent=2, ensure_ascii=False)
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(company_data, option=orjson.OPT_INDENT_2))
         
-        print(f"✓ Saved to {output_path}", flush=True)
-        print("=" * 60, flush=True)
+        log.info(f"✓ Saved to {output_path}")
+        log.info("=" * 60)
         
         return True
         
+    except StepCancelled as e:
+        # No fallback file either: the caller has already given up on this run
+        log.error(f"✗ {str(e)}, no output written")
+        return False
+    
     except Exception as e:
-        print(f"✗ FATAL ERROR: {str(e)}", flush=True)
+        log.error(f"✗ FATAL ERROR: {str(e)}")
         import traceback
         traceback.print_exc()
         
         # Try to save empty structure so process doesn't completely fail
         try:
-            empty_data = {
-                "company_name": "",
-                "address": "",
-                "phone": "",
-                "email": "",
-                "website": "",
-                "tax_id": "",
-                "registration_no": "",
-                "bank_details": {
-                    "bank_name": "",
-                    "iban": "",
-                    "swift": "",
-                    "account_holder": ""
-                },
-                "standard_terms": {
-                    "delivery": "",
-                    "payment": "",
-                    "warranty": ""
-                },
-                "legal_info": "",
-                "logo": None
-            }
+            empty_data = empty_company_data()
             
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(empty_data, f, indent=2, ensure_ascii=False)
+            with open(output_path, 'wb') as f:
+                f.write(orjson.dumps(empty_data, option=orjson.OPT_INDENT_2))
             
-            print("⚠ Saved empty company data structure to allow process to continue", flush=True)
+            log.warning("⚠ Saved empty company data structure to allow process to continue")
         except:
             pass
         
         return False
+    
+    finally:
+        # Called in-process by the API: write out what is still buffered
+        flush_log(log)
 
 if __name__ == "__main__":
-    print("Company Data Extraction Script Started", flush=True)
+    log.info("Company Data Extraction Script Started")
     
     offer2_path = os.path.join(BASE_DIR, "offer2_template.docx")
     output_path = os.path.join(OUTPUT_FOLDER, "company_data.json")
     
     if not os.path.exists(offer2_path):
-        print(f"✗ Template not found at {offer2_path}", flush=True)
+        log.error(f"✗ Template not found at {offer2_path}")
         sys.exit(1)
     
     success = extract_company_data_from_offer2(offer2_path, output_path)
     
     if not success:
-        print("✗ Extraction failed", flush=True)
+        log.error("✗ Extraction failed")
         sys.exit(1)
     
-    print("✓ COMPLETED SUCCESSFULLY", flush=True)
+    log.info("✓ COMPLETED SUCCESSFULLY")
     sys.exit(0)
\ No newline at end of file
@@ -1,6 +1,6 @@
 import os
 import sys
-import json
+import orjson
 import openai
 import fitz
 import base64
@@ -145,21 +145,18 @@ Return ONLY JSON:
             model="gpt-4o",
             messages=[{"role": "user", "content": content}],
             max_tokens=MAX_TOKENS,
-            temperature=0
+            temperature=0,
+            response_format={"type": "json_object"}
         )
         
         api_time = time.time() - api_start
         print(f"Received response from OpenAI in {api_time:.1f}s", flush=True)
         
-        extracted_json = response.choices[0].message.content.strip()
-        
-        if extracted_json.startswith("```json"):
-            extracted_json = extracted_json.replace("```json", "").replace("```", "").strip()
-        elif extracted_json.startswith("```"):
-            extracted_json = extracted_json.replace("```", "").strip()
+        # JSON mode: the reply is a bare object, no markdown fences to strip
+        extracted_json = response.choices[0].message.content
         
         print("Parsing JSON...", flush=True)
-        full_data = json.loads(extracted_json)
+        full_data = orjson.loads(extracted_json)
         
         items = full_data.get("items", [])
         technical_sections = full_data.get("technical_sections", [])
@@ -178,10 +175,7 @@ Return ONLY JSON:
         # Group items by category
         categories = {}
         for item in items:
-            cat = item.get("category", "Main Items")
-            if cat not in categories:
-                categories[cat] = []
-            categories[cat].append(item)
+            categories.setdefault(item.get("category", "Main Items"), []).append(item)
         
         print(f"Found {len(categories)} categories:", flush=True)
         for cat, cat_items in categories.items():
@@ -196,8 +190,8 @@ Return ONLY JSON:
             "categories": list(categories.keys())
         }
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
         
         total_time = time.time() - start_time
         print(f"Saved to {output_path}", flush=True)
@@ -8,79 +8,57 @@ PHASE 3: Extract ALL technical content with context-aware matching
 
 import os
 import sys
-import json
+import orjson
 import openai
 import fitz
 import base64
 import time
+import hashlib
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 from difflib import SequenceMatcher
+from pipeline_common import (MAX_RETRIES, RETRYABLE_ERRORS, retry_delay,
+                             share_openai_session, buffered_logger, flush_log,
+                             StepCancelled, check_cancelled)
 
 openai.api_key = os.environ.get('OPENAI_API_KEY')
+share_openai_session()
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 OUTPUT_FOLDER = os.path.join(BASE_DIR, 'outputs')
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# Progress output is buffered (see pipeline_common.buffered_logger)
+log = buffered_logger('requote.extract_items')
+
 # Configuration
 MAX_PAGES = 15
 IMAGE_SCALE = 1.5
-MAX_TOKENS_CONTEXT = 2000
+MAX_TOKENS_CONTEXT = 500
 MAX_TOKENS_PRICING = 4000
 MAX_TOKENS_TECHNICAL = 8000
 
-def similarity(a, b):
-    """Calculate similarity between two strings (0-1)"""
-    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+# Pages shown to the Phase 1 context request
+CONTEXT_PAGES = 3
 
-def extract_items_from_pdf(pdf_path, output_path):
-    try:
-        print("=" * 80, flush=True)
-        print("THREE-PHASE SEMANTIC EXTRACTION", flush=True)
-        print("=" * 80, flush=True)
-        
-        start_time = time.time()
-        
-        if not openai.api_key:
-            print("ERROR: OPENAI_API_KEY not set", flush=True)
-            return False
-        
-        print("Reading PDF:", pdf_path, flush=True)
-        
-        if not os.path.exists(pdf_path):
-            print("ERROR: PDF file not found", flush=True)
-            return False
-        
-        # Convert PDF pages to images
-        print("Converting PDF to images...", flush=True)
-        doc = fitz.open(pdf_path)
-        total_pages = len(doc)
-        print(f"PDF has {total_pages} pages", flush=True)
-        
-        max_pages = min(MAX_PAGES, total_pages)
-        print(f"Processing first {max_pages} pages", flush=True)
-        
-        image_data_list = []
-        for page_num in range(max_pages):
-            page = doc[page_num]
-            pix = page.get_pixmap(matrix=fitz.Matrix(IMAGE_SCALE, IMAGE_SCALE))
-            img_bytes = pix.tobytes("png")
-            img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-            image_data_list.append(f"data:image/png;base64,{img_base64}")
-            print(f"  Page {page_num + 1}: converted", flush=True)
-        
-        doc.close()
-        print(f"✓ All pages converted ({time.time() - start_time:.1f}s)", flush=True)
-        
-        # =================================================================
-        # PHASE 1: UNDERSTAND THE OFFER CONTEXT
-        # =================================================================
-        print("\n" + "=" * 80, flush=True)
-        print("PHASE 1: UNDERSTANDING OFFER CONTEXT", flush=True)
-        print("=" * 80, flush=True)
-        
-        context_content = [
-            {"type": "text", "text": """Analyze this commercial offer and provide context.
+# Longest item name / product text repeated into the Phase 3 prompt; the
+# names only serve as matching labels, full names stay in the items list
+MAX_REFERENCE_CHARS = 200
+
+# Phase 1 only emits a four-field JSON object, a small model is enough;
+# set CONTEXT_MODEL=gpt-4o to roll back
+CONTEXT_MODEL = os.environ.get('CONTEXT_MODEL', 'gpt-4o-mini')
+
+# Extraction results are cached per PDF content (newest entries kept);
+# bump the version when prompts or models change, set REQUOTE_NO_CACHE=1
+# to always call the API
+EXTRACTION_PROMPT_VERSION = "3"
+EXTRACTION_CACHE_DIR = os.path.join(OUTPUT_FOLDER, 'extraction_cache')
+EXTRACTION_CACHE_MAX_ENTRIES = 50
+EXTRACTION_CACHE_DISABLED = os.environ.get('REQUOTE_NO_CACHE', '').lower() in ('1', 'true', 'yes')
+
+CONTEXT_PROMPT = """Analyze this commercial offer and provide context.
 
 Answer these questions:
 1. What is the MAIN equipment/product being offered?
@@ -94,46 +72,9 @@ Return ONLY JSON:
   "industry": "Industry sector",
   "offer_type": "quotation" or "catalog" or "technical sheet"
 }
-"""}
-        ]
-        
-        # Use only first 3 pages for context
-        for img_data in image_data_list[:3]:
-            context_content.append({"type": "image_url", "image_url": {"url": img_data}})
-        
-        print("Calling GPT-4o for context analysis...", flush=True)
-        phase1_start = time.time()
-        
-        response_context = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": context_content}],
-            max_tokens=MAX_TOKENS_CONTEXT,
-            temperature=0
-        )
-        
-        print(f"✓ Phase 1 completed ({time.time() - phase1_start:.1f}s)", flush=True)
-        
-        context_json = response_context.choices[0].message.content.strip()
-        if context_json.startswith("```json"):
-            context_json = context_json.replace("```json", "").replace("```", "").strip()
-        elif context_json.startswith("```"):
-            context_json = context_json.replace("```", "").strip()
-        
-        offer_context = json.loads(context_json)
-        print(f"Offer context:", flush=True)
-        print(f"  Main product: {offer_context.get('main_product', 'Unknown')}", flush=True)
-        print(f"  Supplier: {offer_context.get('supplier', 'Unknown')}", flush=True)
-        print(f"  Industry: {offer_context.get('industry', 'Unknown')}", flush=True)
-        
-        # =================================================================
-        # PHASE 2: EXTRACT PRICING TABLE
-        # =================================================================
-        print("\n" + "=" * 80, flush=True)
-        print("PHASE 2: EXTRACTING PRICING TABLE", flush=True)
-        print("=" * 80, flush=True)
-        
-        pricing_content = [
-            {"type": "text", "text": """Extract the PRICING TABLE with item identification keys.
+"""
+
+PRICING_PROMPT = """Extract the PRICING TABLE with item identification keys.
 
 For each priced item, extract:
 - item_number: Position in table (1, 2, 3, etc.)
@@ -146,80 +87,40 @@ For each priced item, extract:
 CRITICAL: Extract the COMPLETE item_name exactly as written in the table.
 This is the key for matching technical descriptions later.
 
-Return ONLY JSON array:
-[{
+Return ONLY a JSON object with an "items" array:
+{"items": [{
   "item_number": 1,
   "category": "Main Equipment",
   "item_name": "MODULAR CM 576-9-SM-4B 2-0-0-0-0",
   "quantity": "1",
   "unit_price": "€150.320,00",
   "total_price": "€150.320,00"
-}]
-"""}
-        ]
-        
-        for img_data in image_data_list:
-            pricing_content.append({"type": "image_url", "image_url": {"url": img_data}})
-        
-        print("Calling GPT-4o for pricing extraction...", flush=True)
-        phase2_start = time.time()
-        
-        response_pricing = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": pricing_content}],
-            max_tokens=MAX_TOKENS_PRICING,
-            temperature=0
-        )
-        
-        print(f"✓ Phase 2 completed ({time.time() - phase2_start:.1f}s)", flush=True)
-        
-        pricing_json = response_pricing.choices[0].message.content.strip()
-        if pricing_json.startswith("```json"):
-            pricing_json = pricing_json.replace("```json", "").replace("```", "").strip()
-        elif pricing_json.startswith("```"):
-            pricing_json = pricing_json.replace("```", "").strip()
-        
-        items = json.loads(pricing_json)
-        print(f"✓ Extracted {len(items)} pricing items", flush=True)
-        
-        # =================================================================
-        # PHASE 3: EXTRACT TECHNICAL CONTENT WITH SEMANTIC TAGS
-        # =================================================================
-        print("\n" + "=" * 80, flush=True)
-        print("PHASE 3: EXTRACTING TECHNICAL CONTENT", flush=True)
-        print("=" * 80, flush=True)
-        
-        # Build item reference list for GPT
-        item_reference = "\n".join([
-            f"{item['item_number']}. {item['item_name']}"
-            for item in items
-        ])
-        
-        technical_content = [
-            {"type": "text", "text": f"""Extract ALL TECHNICAL CONTENT and match it to the correct items.
-
-CONTEXT:
-This is a quotation for: {offer_context.get('main_product', 'industrial equipment')}
+}]}
+"""
 
-PRICING TABLE ITEMS (for reference):
-{item_reference}
+# Phase 3 prompt is static apart from the main product and the item list,
+# so it is kept as fixed segments and joined per call (no str.format scan
+# over the whole prompt, no brace escaping in the JSON examples)
+# Static instructions come first and the per-offer data last, so repeated
+# calls share a byte-identical prompt prefix (server-side prompt caching)
+TECHNICAL_PROMPT = """Extract ALL TECHNICAL CONTENT and match it to the correct items.
 
 YOUR TASK:
 Extract all technical descriptions that appear AFTER the pricing table.
 
 For EACH technical section you find:
 1. Read the section heading carefully
-2. Determine WHICH item from the pricing table it describes
+2. Determine WHICH item from the pricing table it describes (see PRICING TABLE ITEMS below)
 3. Extract the COMPLETE content (do NOT truncate)
 
-Return JSON array where each object has:
-{{
+Return a JSON object with a "sections" array where each section has:
+{
   "matched_item_number": [Which item number(s) this describes - can be multiple],
   "heading": "The section title",
   "full_content": "COMPLETE verbatim text - do NOT summarize",
   "specifications": "Any structured specs (separate paragraph)",
   "matching_confidence": "high" or "medium" or "low"
-}}
+}
 
 MATCHING RULES:
 - If heading contains exact item name → matched_item_number = that item
@@ -235,62 +136,419 @@ EXTRACTION RULES:
 - Stop when you see "Commercial Terms" or "Payment Terms"
 
 Example output:
-[{{
+{"sections": [{
   "matched_item_number": [1],
   "heading": "1. MODULAR CM 576-9-SM-4B 2-0-0-0-0",
   "full_content": "The MODULAR CM 576-9-SM-4B 2-0-0-0-0 is an automatic rotary labelling machine...[COMPLETE TEXT]",
   "specifications": "Label length: 12-140mm, Label height: 20-180mm...",
   "matching_confidence": "high"
-}},
-{{
+},
+{
   "matched_item_number": [3],
   "heading": "3. Conveyor motor drive with Rossi motoreducer 0,55kw",
   "full_content": "Automatic rotary labelling machine made with...[COMPLETE TEXT]",
   "specifications": "",
   "matching_confidence": "high"
-}}]
+}]}
+
+Return ONLY a valid JSON object.
+"""
+
+TECHNICAL_PROMPT_CONTEXT = """
+CONTEXT:
+This is a quotation for: """
+
+TECHNICAL_PROMPT_ITEMS = """
+
+PRICING TABLE ITEMS (for reference):
+"""
+
+# Each wait for streamed data is bounded; retries follow the shared policy
+# in pipeline_common
+REQUEST_TIMEOUT = 60
+
+# Fields every parsed pricing item / technical section is guaranteed to have
+ITEM_DEFAULTS = {
+    "item_number": None,
+    "category": "Items",
+    "item_name": "",
+    "quantity": "1",
+    "unit_price": "",
+    "total_price": ""
+}
+SECTION_DEFAULTS = {
+    "matched_item_number": [],
+    "heading": "",
+    "full_content": "",
+    "specifications": "",
+    "matching_confidence": "low"
+}
 
-Return ONLY valid JSON array.
-"""}
-        ]
+# Keeps replies to the bare JSON value (no preamble, no notes)
+SYSTEM_PROMPT = "Output only the requested JSON. No prose, no markdown."
+
+# Trailing chatter the model sometimes adds after the JSON block
+STOP_SEQUENCES = ["```\n\n", "\n\nNote:"]
+
+def stream_json_completion(content, max_tokens, model="gpt-4o", json_object=False):
+    """
+    Stream a GPT-4o reply and stop reading as soon as the first top-level
+    JSON object/array is closed (brace depth tracked per delta), so tail
+    tokens after the JSON block are never waited for
+    """
+    request = dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": content}
+        ],
+        max_tokens=max_tokens,
+        temperature=0,
+        stop=STOP_SEQUENCES,
+        stream=True,
+        request_timeout=REQUEST_TIMEOUT
+    )
+    if json_object:
+        # Server-side JSON mode: reply is a bare object, no fences
+        request['response_format'] = {"type": "json_object"}
+    
+    for attempt in range(MAX_RETRIES):
+        try:
+            return read_json_stream(openai.ChatCompletion.create(**request))
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = retry_delay(e, attempt)
+            log.warning(f"⚠ OpenAI request failed ({e}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+def read_json_stream(response):
+    """Collect streamed deltas up to the end of the first JSON value"""
+    pieces = []
+    depth = 0
+    in_string = False
+    escaped = False
+    
+    for chunk in response:
+        text = chunk['choices'][0]['delta'].get('content') or ''
+        
+        for pos, ch in enumerate(text):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"' and depth:
+                in_string = True
+            elif ch in '{[':
+                depth += 1
+            elif ch in '}]' and depth:
+                depth -= 1
+                if depth == 0:
+                    # Drop whatever follows the closing bracket
+                    pieces.append(text[:pos + 1])
+                    return "".join(pieces)
+        
+        pieces.append(text)
+    
+    return "".join(pieces)
+
+def truncate_text(text, max_len=MAX_REFERENCE_CHARS):
+    """Cut text to max_len characters, noting how much was dropped"""
+    text = str(text)
+    if len(text) <= max_len:
+        return text
+    return f"{text[:max_len]}…[+{len(text) - max_len} chars]"
+
+def parse_json_list(raw, key, defaults):
+    """
+    Parse a JSON-mode reply ({key: [...]}) into a list of dicts that have
+    every field in defaults (missing or null fields take a fresh copy of
+    the default value). Raises ValueError when the reply has no key list
+    """
+    data = orjson.loads(raw)
+    entries = data.get(key) if isinstance(data, dict) else data
+    if not isinstance(entries, list):
+        raise ValueError(f"GPT reply has no '{key}' list")
+    
+    parsed = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        row = {field: copy(default) for field, default in defaults.items()}
+        row.update((field, value) for field, value in entry.items() if value is not None)
+        parsed.append(row)
+    return parsed
+
+def similarity(a, b):
+    """Calculate similarity between two strings (0-1)"""
+    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+
+def extraction_cache_key(pdf_path):
+    """
+    SHA-256 of the PDF bytes plus everything else the extraction depends
+    on (prompt version, context model, page/image settings)
+    """
+    digest = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    digest.update(f"|{EXTRACTION_PROMPT_VERSION}|{CONTEXT_MODEL}|{MAX_PAGES}|{IMAGE_SCALE}".encode('utf-8'))
+    return digest.hexdigest()
+
+def load_cached_extraction(cache_key):
+    """Return the cached output file bytes for a PDF, or None on miss"""
+    if EXTRACTION_CACHE_DISABLED:
+        return None
+    
+    cache_path = os.path.join(EXTRACTION_CACHE_DIR, f"{cache_key}.json")
+    try:
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        os.utime(cache_path)  # mark as recently used
+        return data
+    except OSError:
+        return None
+
+def save_cached_extraction(cache_key, data):
+    """Store output file bytes (atomically) and drop least recently used entries"""
+    if EXTRACTION_CACHE_DISABLED:
+        return
+    
+    os.makedirs(EXTRACTION_CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(EXTRACTION_CACHE_DIR, f"{cache_key}.json")
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, cache_path)
+    
+    entries = []
+    for entry in os.scandir(EXTRACTION_CACHE_DIR):
+        if entry.name.endswith('.json'):
+            entries.append((entry.stat().st_mtime, entry.path))
+    entries.sort(reverse=True)
+    for _, path in entries[EXTRACTION_CACHE_MAX_ENTRIES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def extract_items_from_pdf(pdf_path, output_path, cancel=None):
+    """
+    Three-phase GPT extraction of the offer's items into output_path.
+    cancel: optional threading.Event; once set, the run stops at the next
+    phase boundary without writing any output
+    """
+    try:
+        log.info("=" * 80)
+        log.info("THREE-PHASE SEMANTIC EXTRACTION")
+        log.info("=" * 80)
         
-        for img_data in image_data_list:
-            technical_content.append({"type": "image_url", "image_url": {"url": img_data}})
+        start_time = time.time()
         
-        print("Calling GPT-4o for technical extraction...", flush=True)
-        phase3_start = time.time()
+        if not openai.api_key:
+            log.error("ERROR: OPENAI_API_KEY not set")
+            return False
+        
+        log.info(f"Reading PDF: {pdf_path}")
+        
+        if not os.path.exists(pdf_path):
+            log.error("ERROR: PDF file not found")
+            return False
         
-        response_technical = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": technical_content}],
-            max_tokens=MAX_TOKENS_TECHNICAL,
-            temperature=0
-        )
+        # Same PDF extracted before: reuse the result, no GPT calls
+        cache_key = extraction_cache_key(pdf_path)
+        cached = load_cached_extraction(cache_key)
+        if cached is not None:
+            check_cancelled(cancel)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, 'wb') as f:
+                f.write(cached)
+            log.info(f"✓ Using cached extraction (PDF unchanged, {time.time() - start_time:.1f}s)")
+            return True
         
-        print(f"✓ Phase 3 completed ({time.time() - phase3_start:.1f}s)", flush=True)
+        # Convert PDF pages to images
+        log.info("Converting PDF to images...")
+        doc = fitz.open(pdf_path)
+        total_pages = len(doc)
+        log.info(f"PDF has {total_pages} pages")
         
-        technical_json = response_technical.choices[0].message.content.strip()
-        if technical_json.startswith("```json"):
-            technical_json = technical_json.replace("```json", "").replace("```", "").strip()
-        elif technical_json.startswith("```"):
-            technical_json = technical_json.replace("```", "").strip()
+        max_pages = min(MAX_PAGES, total_pages)
+        log.info(f"Processing first {max_pages} pages")
         
-        technical_sections = json.loads(technical_json)
-        print(f"✓ Extracted {len(technical_sections)} technical sections", flush=True)
+        context_pages = min(CONTEXT_PAGES, max_pages)
+        
+        # =================================================================
+        # PHASES 1 + 2: neither needs the other's result, so both requests
+        # are in flight at the same time. Phase 1 only reads the first
+        # pages and is started as soon as those are rendered, overlapping
+        # the rendering of the rest
+        # =================================================================
+        def submit_context(pool, images):
+            # Product, supplier and industry are readable at low detail
+            # (fixed ~85 input tokens per page)
+            context_content = [
+                {"type": "text", "text": CONTEXT_PROMPT}
+            ]
+            for img_data in images:
+                context_content.append({"type": "image_url", "image_url": {"url": img_data, "detail": "low"}})
+            
+            log.info(f"Calling {CONTEXT_MODEL} for context analysis...")
+            flush_log(log)
+            return time.time(), pool.submit(
+                stream_json_completion, context_content, MAX_TOKENS_CONTEXT,
+                model=CONTEXT_MODEL, json_object=True
+            )
+        
+        # Not used as a context manager: if rendering or a request fails,
+        # the other request in flight is abandoned instead of waited for
+        pool = ThreadPoolExecutor(max_workers=2)
+        context_future = None
+        try:
+            image_data_list = []
+            for page_num in range(max_pages):
+                page = doc[page_num]
+                pix = page.get_pixmap(matrix=fitz.Matrix(IMAGE_SCALE, IMAGE_SCALE))
+                img_bytes = pix.tobytes("png")
+                img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+                image_data_list.append(f"data:image/png;base64,{img_base64}")
+                log.info(f"  Page {page_num + 1}: converted")
+                
+                if len(image_data_list) == context_pages:
+                    phase1_start, context_future = submit_context(pool, image_data_list)
+            
+            doc.close()
+            log.info(f"✓ All pages converted ({time.time() - start_time:.1f}s)")
+            
+            # No pages rendered (empty PDF): the loop never started Phase 1
+            if context_future is None:
+                phase1_start, context_future = submit_context(pool, image_data_list)
+            
+            # Page images first, prompt last (see Phase 3)
+            pricing_content = [
+                {"type": "image_url", "image_url": {"url": img_data}}
+                for img_data in image_data_list
+            ]
+            pricing_content.append({"type": "text", "text": PRICING_PROMPT})
+            
+            log.info("\nCalling GPT-4o for pricing extraction...")
+            flush_log(log)
+            phase2_start = time.time()
+            pricing_future = pool.submit(
+                stream_json_completion, pricing_content, MAX_TOKENS_PRICING,
+                json_object=True
+            )
+            
+            context_raw = context_future.result()
+            phase1_time = time.time() - phase1_start
+            pricing_raw = pricing_future.result()
+            phase2_time = time.time() - phase2_start
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        
+        check_cancelled(cancel)
+        
+        # =================================================================
+        # PHASE 1: UNDERSTAND THE OFFER CONTEXT
+        # =================================================================
+        log.info("\n" + "=" * 80)
+        log.info("PHASE 1: UNDERSTANDING OFFER CONTEXT")
+        log.info("=" * 80)
+        
+        log.info(f"✓ Phase 1 completed ({phase1_time:.1f}s)")
+        
+        offer_context = orjson.loads(context_raw)
+        log.info(f"Offer context:")
+        log.info(f"  Main product: {offer_context.get('main_product', 'Unknown')}")
+        log.info(f"  Supplier: {offer_context.get('supplier', 'Unknown')}")
+        log.info(f"  Industry: {offer_context.get('industry', 'Unknown')}")
+        
+        # =================================================================
+        # PHASE 2: EXTRACT PRICING TABLE
+        # =================================================================
+        log.info("\n" + "=" * 80)
+        log.info("PHASE 2: EXTRACTING PRICING TABLE")
+        log.info("=" * 80)
+        
+        log.info(f"✓ Phase 2 completed ({phase2_time:.1f}s)")
+        
+        items = parse_json_list(pricing_raw, 'items', ITEM_DEFAULTS)
+        for position, item in enumerate(items, 1):
+            if item['item_number'] is None:
+                item['item_number'] = position
+        log.info(f"✓ Extracted {len(items)} pricing items")
+        
+        # =================================================================
+        # PHASE 3: EXTRACT TECHNICAL CONTENT WITH SEMANTIC TAGS
+        # =================================================================
+        log.info("\n" + "=" * 80)
+        log.info("PHASE 3: EXTRACTING TECHNICAL CONTENT")
+        log.info("=" * 80)
+        
+        # Sections can only be matched to pricing items - without any there
+        # is nothing to ask GPT for
+        if not items:
+            log.info("⚠ No pricing items, skipping technical extraction")
+            technical_sections = []
+        else:
+            # Build item reference list for GPT
+            item_reference = "\n".join([
+                f"{item['item_number']}. {truncate_text(item['item_name'])}"
+                for item in items
+            ])
+            
+            # Same page images as Phase 2, sent first so both requests share
+            # the (large) image prefix
+            technical_content = [
+                {"type": "image_url", "image_url": {"url": img_data}}
+                for img_data in image_data_list
+            ]
+            technical_content.append({"type": "text", "text": "".join((
+                TECHNICAL_PROMPT,
+                TECHNICAL_PROMPT_CONTEXT,
+                truncate_text(offer_context.get('main_product') or 'industrial equipment'),
+                TECHNICAL_PROMPT_ITEMS,
+                item_reference
+            ))})
+            
+            check_cancelled(cancel)
+            log.info("Calling GPT-4o for technical extraction...")
+            flush_log(log)
+            phase3_start = time.time()
+            
+            technical_raw = stream_json_completion(technical_content, MAX_TOKENS_TECHNICAL, json_object=True)
+            
+            log.info(f"✓ Phase 3 completed ({time.time() - phase3_start:.1f}s)")
+            
+            technical_sections = parse_json_list(technical_raw, 'sections', SECTION_DEFAULTS)
+        
+        log.info(f"✓ Extracted {len(technical_sections)} technical sections")
         
         # =================================================================
         # SMART MATCHING: Assign technical content to items
         # =================================================================
-        print("\n" + "=" * 80, flush=True)
-        print("SEMANTIC MATCHING: Assigning technical content to items", flush=True)
-        print("=" * 80, flush=True)
+        log.info("\n" + "=" * 80)
+        log.info("SEMANTIC MATCHING: Assigning technical content to items")
+        log.info("=" * 80)
         
         # Initialize empty descriptions
         for item in items:
             item['description'] = ''
             item['specifications'] = ''
             item['details'] = ''
-            item['matched_sections'] = []
+        
+        # Matched text per item (multiple sections can describe the same
+        # item), joined once after matching
+        description_parts = [[] for _ in items]
+        specification_parts = [[] for _ in items]
+        
+        # Item positions by item_number, built once instead of scanning all
+        # items for every matched number
+        positions_by_number = {}
+        for idx, item in enumerate(items):
+            positions_by_number.setdefault(item['item_number'], []).append(idx)
         
         # Assign based on GPT's matching
         for section in technical_sections:
@@ -303,38 +561,26 @@ Return ONLY valid JSON array.
             specs = section.get('specifications', '')
             
             for num in matched_nums:
-                # Find item by number
-                for item in items:
-                    if item['item_number'] == num:
-                        # Append content (multiple sections can describe same item)
-                        if item['description']:
-                            item['description'] += "\n\n" + content
-                        else:
-                            item['description'] = content
-                        
-                        if specs:
-                            if item['specifications']:
-                                item['specifications'] += " " + specs
-                            else:
-                                item['specifications'] = specs
-                        
-                        item['matched_sections'].append({
-                            'heading': section.get('heading', ''),
-                            'confidence': confidence
-                        })
-                        
-                        print(f"  ✓ Matched section '{section.get('heading', 'Unknown')[:50]}...' to item {num} ({confidence} confidence)", flush=True)
+                for idx in positions_by_number.get(num, ()):
+                    description_parts[idx].append(content)
+                    specification_parts[idx].append(specs)
+                    
+                    log.info(f"  ✓ Matched section '{section.get('heading', 'Unknown')[:50]}...' to item {num} ({confidence} confidence)")
+        
+        for item, descriptions, specifications in zip(items, description_parts, specification_parts):
+            item['description'] = "\n\n".join(filter(None, descriptions))
+            item['specifications'] = " ".join(filter(None, specifications))
         
         # Report matching statistics
         matched_count = sum(1 for item in items if item['description'])
-        print(f"\n✓ Successfully matched {matched_count}/{len(items)} items", flush=True)
+        log.info(f"\n✓ Successfully matched {matched_count}/{len(items)} items")
         
         # Show unmatched items
         unmatched = [item for item in items if not item['description']]
         if unmatched:
-            print(f"\n⚠ {len(unmatched)} items without technical descriptions:", flush=True)
+            log.info(f"\n⚠ {len(unmatched)} items without technical descriptions:")
             for item in unmatched:
-                print(f"  - Item {item['item_number']}: {item['item_name']}", flush=True)
+                log.info(f"  - Item {item['item_number']}: {item['item_name']}")
         
         # =================================================================
         # SAVE OUTPUT
@@ -353,47 +599,56 @@ Return ONLY valid JSON array.
             }
         }
         
-        # Clean up matched_sections before saving (optional)
-        for item in items:
-            if 'matched_sections' in item:
-                del item['matched_sections']
-        
+        output_bytes = orjson.dumps(output_data, option=orjson.OPT_INDENT_2)
+        check_cancelled(cancel)
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
+        with open(output_path, 'wb') as f:
+            f.write(output_bytes)
+        # An empty result may be a bad reply - don't serve it for every
+        # later upload of the same PDF
+        if items:
+            save_cached_extraction(cache_key, output_bytes)
         
         total_time = time.time() - start_time
         
-        print("\n" + "=" * 80, flush=True)
-        print("EXTRACTION COMPLETED SUCCESSFULLY", flush=True)
-        print("=" * 80, flush=True)
-        print(f"Total time: {total_time:.1f}s", flush=True)
-        print(f"Output: {output_path}", flush=True)
-        print(f"Match rate: {matched_count}/{len(items)} ({matched_count*100//len(items) if items else 0}%)", flush=True)
-        print("=" * 80, flush=True)
+        log.info("\n" + "=" * 80)
+        log.info("EXTRACTION COMPLETED SUCCESSFULLY")
+        log.info("=" * 80)
+        log.info(f"Total time: {total_time:.1f}s")
+        log.info(f"Output: {output_path}")
+        log.info(f"Match rate: {matched_count}/{len(items)} ({matched_count*100//len(items) if items else 0}%)")
+        log.info("=" * 80)
         
         return True
         
+    except StepCancelled as e:
+        log.error(f"\n✗ {str(e)}, no output written")
+        return False
+    
     except Exception as e:
-        print(f"\n✗ FATAL ERROR: {str(e)}", flush=True)
+        log.error(f"\n✗ FATAL ERROR: {str(e)}")
         import traceback
         traceback.print_exc()
         return False
+    
+    finally:
+        # Called in-process by the API: write out what is still buffered
+        flush_log(log)
 
 if __name__ == "__main__":
-    print("Three-Phase Semantic Extraction Script Started", flush=True)
+    log.info("Three-Phase Semantic Extraction Script Started")
     pdf_path = os.path.join(UPLOAD_FOLDER, "offer1.pdf")
     output_path = os.path.join(OUTPUT_FOLDER, "items_offer1.json")
     
     if not os.path.exists(pdf_path):
-        print("ERROR: PDF not found at " + pdf_path, flush=True)
+        log.error("ERROR: PDF not found at " + pdf_path)
         sys.exit(1)
     
     success = extract_items_from_pdf(pdf_path, output_path)
     
     if not success:
-        print("Extraction failed", flush=True)
+        log.error("Extraction failed")
         sys.exit(1)
     
-    print("COMPLETED SUCCESSFULLY", flush=True)
+    log.info("COMPLETED SUCCESSFULLY")
     sys.exit(0)
\ No newline at end of file
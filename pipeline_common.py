@@ -0,0 +1,105 @@
+"""
+Shared helpers for the pipeline scripts (extract_pdf_direct_enhanced.py,
+extract_company_data.py, build_offer3.py): buffered progress logging,
+cancellation, OpenAI retry policy and HTTP session
+"""
+
+import sys
+import random
+import logging
+import logging.handlers
+import openai
+import requests
+from openai.api_requestor import MAX_CONNECTION_RETRIES, _requests_proxies_arg
+
+# Progress lines buffered before they are written out
+LOG_BUFFER_LINES = 200
+
+# Connections kept open per host in the shared session - enough for every
+# API worker thread plus the request pools inside each pipeline step
+SESSION_POOL_SIZE = 32
+
+# Transient API failures are retried with exponential backoff + jitter, or
+# after the server-suggested Retry-After delay (at most MAX_RETRY_DELAY).
+# openai only wraps errors raised while opening a streamed request; a stall
+# or dropped connection while the stream is read surfaces as a plain
+# requests error, and retrying re-issues the whole request
+MAX_RETRIES = 3
+MAX_RETRY_DELAY = 30
+RETRYABLE_ERRORS = (
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    requests.exceptions.RequestException
+)
+
+def buffered_logger(name):
+    """
+    Logger for a step's progress output: lines are buffered and written to
+    stdout in batches - on flush_log (before long waits, when a run ends),
+    on errors and at interpreter exit - instead of one flush=True write
+    per line
+    """
+    log = logging.getLogger(name)
+    if not log.handlers:
+        log.setLevel(logging.INFO)
+        log.propagate = False
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(logging.Formatter('%(message)s'))
+        log.addHandler(logging.handlers.MemoryHandler(LOG_BUFFER_LINES, flushLevel=logging.ERROR, target=stream))
+    return log
+
+def flush_log(log):
+    """Write out the buffered progress lines"""
+    for handler in log.handlers:
+        handler.flush()
+
+class StepCancelled(Exception):
+    """Raised inside a step whose run was cancelled (e.g. it timed out)"""
+
+def check_cancelled(cancel):
+    """
+    Stop the step if its cancel event is set; called between phases and
+    before any output is written, so a cancelled run leaves no files
+    """
+    if cancel is not None and cancel.is_set():
+        raise StepCancelled("step cancelled (timed out)")
+
+def retry_delay(error, attempt):
+    """
+    Seconds to wait before retrying: the server's Retry-After hint when
+    the error carries one (rate limits), capped, otherwise exponential
+    backoff; both with jitter. Never negative (bad headers included)
+    """
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        delay = min(float(headers.get('retry-after')), MAX_RETRY_DELAY)
+    except (TypeError, ValueError):
+        delay = 2 ** attempt
+    return max(0.0, delay) + random.random()
+
+def share_openai_session():
+    """
+    Give openai one HTTP session (and connection pool) shared by every
+    thread, so warm connections are reused; by default it opens a new
+    session per thread, i.e. per request in the API's worker threads.
+    Set up like openai's own sessions (proxy, connection retries), only
+    with a pool sized for all threads
+    """
+    if openai.requestssession is not None:
+        return
+    
+    session = requests.Session()
+    proxies = _requests_proxies_arg(openai.proxy)
+    if proxies:
+        session.proxies = proxies
+    session.mount(
+        "https://",
+        requests.adapters.HTTPAdapter(
+            max_retries=MAX_CONNECTION_RETRIES,
+            pool_maxsize=SESSION_POOL_SIZE
+        )
+    )
+    openai.requestssession = session
@@ -4,24 +4,125 @@ Works on any server including Render.com free tier
 Converts to PDF to preserve structure for GPT-4 Vision
 """
 
-from docx import Document
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image as RLImage, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
-import openpyxl
-from PIL import Image
 import os
 import shutil
 
 
+# Paragraph and table styles are the same for every conversion - built once
+# at import instead of on each call
+_STYLES = getSampleStyleSheet()
+
+# ReportLab markup escaping in one pass over the text
+_XML_ESC = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# Sheets are laid out as several tables of at most this many data rows (each
+# with the header row repeated) - ReportLab's table layout slows down
+# super-linearly with the row count of a single table
+TABLE_CHUNK_ROWS = 50
+
+TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=_STYLES['Heading1'],
+    fontSize=18,
+    textColor=colors.HexColor('#000000'),
+    spaceAfter=12,
+    spaceBefore=12,
+    alignment=TA_LEFT
+)
+
+HEADING_STYLE = ParagraphStyle(
+    'CustomHeading',
+    parent=_STYLES['Heading2'],
+    fontSize=14,
+    textColor=colors.HexColor('#333333'),
+    spaceAfter=10,
+    spaceBefore=10,
+    alignment=TA_LEFT
+)
+
+NORMAL_STYLE = ParagraphStyle(
+    'CustomNormal',
+    parent=_STYLES['Normal'],
+    fontSize=11,
+    textColor=colors.HexColor('#000000'),
+    spaceAfter=6,
+    alignment=TA_JUSTIFY,
+    leading=14
+)
+
+SHEET_HEADING_STYLE = _STYLES['Heading1']
+
+DOCX_TABLE_STYLE = TableStyle([
+    # Header row styling
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 11),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('TOPPADDING', (0, 0), (-1, 0), 12),
+
+    # Data rows styling
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 10),
+    ('TOPPADDING', (0, 1), (-1, -1), 8),
+    ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
+    ('LEFTPADDING', (0, 0), (-1, -1), 6),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+
+    # Alternating row colors
+    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F2F2F2')]),
+
+    # Grid
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('BOX', (0, 0), (-1, -1), 1, colors.black),
+
+    # Alignment
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+
+XLSX_TABLE_STYLE = TableStyle([
+    # Header row
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#217346')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
+    ('TOPPADDING', (0, 0), (-1, 0), 10),
+
+    # Data rows
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 9),
+    ('TOPPADDING', (0, 1), (-1, -1), 6),
+    ('BOTTOMPADDING', (0, 1), (-1, -1), 6),
+    ('LEFTPADDING', (0, 0), (-1, -1), 4),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 4),
+
+    # Grid
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('BOX', (0, 0), (-1, -1), 1, colors.black),
+
+    # Alternating rows
+    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#E7E6E6')]),
+
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+
+
 def convert_docx_to_pdf_python(docx_path, pdf_path):
     """Convert DOCX to PDF using reportlab (preserves structure)"""
     try:
         print("  Converting DOCX to PDF using Python libraries...", flush=True)
         
+        from docx import Document
+        
         # Read DOCX
         doc = Document(docx_path)
         
@@ -32,57 +133,29 @@ def convert_docx_to_pdf_python(docx_path, pdf_path):
             rightMargin=72,
             leftMargin=72,
             topMargin=72,
-            bottomMargin=18
+            bottomMargin=18,
+            # No timestamp/random document ID: the same input converts to
+            # the same bytes, so the extraction cache (keyed on PDF
+            # content) also hits for re-uploaded DOCX/XLSX/image offers
+            invariant=True
         )
         
-        styles = getSampleStyleSheet()
         story = []
         
-        # Create custom styles
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=18,
-            textColor=colors.HexColor('#000000'),
-            spaceAfter=12,
-            spaceBefore=12,
-            alignment=TA_LEFT
-        )
-        
-        heading_style = ParagraphStyle(
-            'CustomHeading',
-            parent=styles['Heading2'],
-            fontSize=14,
-            textColor=colors.HexColor('#333333'),
-            spaceAfter=10,
-            spaceBefore=10,
-            alignment=TA_LEFT
-        )
-        
-        normal_style = ParagraphStyle(
-            'CustomNormal',
-            parent=styles['Normal'],
-            fontSize=11,
-            textColor=colors.HexColor('#000000'),
-            spaceAfter=6,
-            alignment=TA_JUSTIFY,
-            leading=14
-        )
-        
         # Extract content from DOCX
         for paragraph in doc.paragraphs:
             text = paragraph.text.strip()
             if text:
                 # Escape special XML characters for reportlab
-                text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                text = text.translate(_XML_ESC)
                 
                 # Detect heading level
                 if paragraph.style.name == 'Heading 1' or paragraph.style.name == 'Title':
-                    p = Paragraph(text, title_style)
+                    p = Paragraph(text, TITLE_STYLE)
                 elif paragraph.style.name.startswith('Heading'):
-                    p = Paragraph(text, heading_style)
+                    p = Paragraph(text, HEADING_STYLE)
                 else:
-                    p = Paragraph(text, normal_style)
+                    p = Paragraph(text, NORMAL_STYLE)
                 
                 story.append(p)
                 story.append(Spacer(1, 0.1*inch))
@@ -94,7 +167,7 @@ def convert_docx_to_pdf_python(docx_path, pdf_path):
                 row_data = []
                 for cell in row.cells:
                     # Get cell text and escape special characters
-                    cell_text = cell.text.strip().replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                    cell_text = cell.text.strip().translate(_XML_ESC)
                     row_data.append(cell_text)
                 data.append(row_data)
             
@@ -107,37 +180,7 @@ def convert_docx_to_pdf_python(docx_path, pdf_path):
                 # Create table with calculated widths
                 t = Table(data, colWidths=[col_width] * num_cols)
                 
-                # Apply professional styling
-                table_style = TableStyle([
-                    # Header row styling
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, 0), (-1, 0), 11),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                    ('TOPPADDING', (0, 0), (-1, 0), 12),
-                    
-                    # Data rows styling
-                    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                    ('FONTSIZE', (0, 1), (-1, -1), 10),
-                    ('TOPPADDING', (0, 1), (-1, -1), 8),
-                    ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
-                    ('LEFTPADDING', (0, 0), (-1, -1), 6),
-                    ('RIGHTPADDING', (0, 0), (-1, -1), 6),
-                    
-                    # Alternating row colors
-                    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F2F2F2')]),
-                    
-                    # Grid
-                    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                    ('BOX', (0, 0), (-1, -1), 1, colors.black),
-                    
-                    # Alignment
-                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ])
-                
-                t.setStyle(table_style)
+                t.setStyle(DOCX_TABLE_STYLE)
                 story.append(Spacer(1, 0.2*inch))
                 story.append(t)
                 story.append(Spacer(1, 0.3*inch))
@@ -165,8 +208,11 @@ def convert_xlsx_to_pdf_python(xlsx_path, pdf_path):
     try:
         print("  Converting XLSX to PDF using Python libraries...", flush=True)
         
-        # Read Excel
-        workbook = openpyxl.load_workbook(xlsx_path, data_only=True)
+        import openpyxl
+        
+        # Read Excel - only cell values are needed, so read-only mode streams
+        # the sheet XML instead of building a Cell object for every cell
+        workbook = openpyxl.load_workbook(xlsx_path, read_only=True, data_only=True)
         
         # Create PDF
         pdf = SimpleDocTemplate(
@@ -175,74 +221,62 @@ def convert_xlsx_to_pdf_python(xlsx_path, pdf_path):
             rightMargin=36,
             leftMargin=36,
             topMargin=36,
-            bottomMargin=36
+            bottomMargin=36,
+            invariant=True
         )
         
         story = []
-        styles = getSampleStyleSheet()
         
-        # Process all sheets
-        for sheet_idx, sheet_name in enumerate(workbook.sheetnames):
-            sheet = workbook[sheet_name]
-            
-            # Add sheet name as heading
-            if len(workbook.sheetnames) > 1:
-                sheet_heading = Paragraph(f"<b>{sheet_name}</b>", styles['Heading1'])
-                story.append(sheet_heading)
-                story.append(Spacer(1, 0.2*inch))
-            
-            # Extract data
-            data = []
-            for row in sheet.iter_rows(values_only=True):
-                row_data = [str(cell) if cell is not None else '' for cell in row]
-                # Skip completely empty rows
-                if any(cell.strip() for cell in row_data):
-                    data.append(row_data)
-            
-            if data:
-                # Calculate column widths based on content
-                num_cols = len(data[0]) if data else 1
-                available_width = 7.5 * inch
-                col_width = available_width / num_cols
+        try:
+            # Process all sheets
+            for sheet_idx, sheet_name in enumerate(workbook.sheetnames):
+                sheet = workbook[sheet_name]
+                # The stored <dimension> tag can be stale (some exporters
+                # write "A1"), which would cut rows and columns off in
+                # read-only mode - read the rows as they actually are
+                sheet.reset_dimensions()
                 
-                # Create table
-                t = Table(data, colWidths=[col_width] * num_cols)
+                # Add sheet name as heading
+                if len(workbook.sheetnames) > 1:
+                    sheet_heading = Paragraph(f"<b>{sheet_name}</b>", SHEET_HEADING_STYLE)
+                    story.append(sheet_heading)
+                    story.append(Spacer(1, 0.2*inch))
                 
-                # Apply Excel-like styling
-                table_style = TableStyle([
-                    # Header row
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#217346')),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, 0), (-1, 0), 10),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
-                    ('TOPPADDING', (0, 0), (-1, 0), 10),
-                    
-                    # Data rows
-                    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                    ('FONTSIZE', (0, 1), (-1, -1), 9),
-                    ('TOPPADDING', (0, 1), (-1, -1), 6),
-                    ('BOTTOMPADDING', (0, 1), (-1, -1), 6),
-                    ('LEFTPADDING', (0, 0), (-1, -1), 4),
-                    ('RIGHTPADDING', (0, 0), (-1, -1), 4),
+                # Extract data
+                data = []
+                for row in sheet.iter_rows(values_only=True):
+                    # Skip completely empty rows before building their strings
+                    # (non-string values such as numbers and dates never
+                    # stringify to blank)
+                    if any(cell is not None and (not isinstance(cell, str) or cell.strip()) for cell in row):
+                        data.append([str(cell) if cell is not None else '' for cell in row])
+                
+                if data:
+                    # Rows only run to their last filled cell; pad them all to
+                    # the widest one, as a Table needs equal-length rows
+                    num_cols = max(len(row_data) for row_data in data)
+                    for row_data in data:
+                        row_data.extend([''] * (num_cols - len(row_data)))
                     
-                    # Grid
-                    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                    ('BOX', (0, 0), (-1, -1), 1, colors.black),
+                    # Calculate column widths based on content
+                    available_width = 7.5 * inch
+                    col_width = available_width / num_cols
                     
-                    # Alternating rows
-                    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#E7E6E6')]),
+                    # Create tables, one per chunk of rows
+                    header = data[0]
+                    for start in range(1, max(len(data), 2), TABLE_CHUNK_ROWS):
+                        if start > 1:
+                            story.append(Spacer(1, 0.1*inch))
+                        chunk = [header] + data[start:start + TABLE_CHUNK_ROWS]
+                        t = Table(chunk, colWidths=[col_width] * num_cols, repeatRows=1)
+                        t.setStyle(XLSX_TABLE_STYLE)
+                        story.append(t)
                     
-                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ])
-                
-                t.setStyle(table_style)
-                story.append(t)
-                
-                # Add page break between sheets (except for last sheet)
-                if sheet_idx < len(workbook.sheetnames) - 1:
-                    story.append(PageBreak())
+                    # Add page break between sheets (except for last sheet)
+                    if sheet_idx < len(workbook.sheetnames) - 1:
+                        story.append(PageBreak())
+        finally:
+            workbook.close()
         
         # Build PDF
         pdf.build(story)
@@ -267,6 +301,8 @@ def convert_image_to_pdf_python(image_path, pdf_path):
     try:
         print("  Converting image to PDF using Python libraries...", flush=True)
         
+        from PIL import Image
+        
         # Open image to get dimensions
         img = Image.open(image_path)
         img_width, img_height = img.size
@@ -296,7 +332,7 @@ def convert_image_to_pdf_python(image_path, pdf_path):
                 new_height = new_width * aspect
         
         # Create PDF
-        pdf = SimpleDocTemplate(pdf_path, pagesize=A4)
+        pdf = SimpleDocTemplate(pdf_path, pagesize=A4, invariant=True)
         story = []
         
         # Center the image
@@ -7,12 +7,17 @@ import os
 from docx import Document
 from docx.shared import Pt, RGBColor, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from docx.oxml import OxmlElement
+from docx.oxml.ns import qn, nsdecls
+from docx.oxml import OxmlElement, parse_xml
+from docx.table import _Cell
+from copy import deepcopy
+from collections import defaultdict
 import base64
 import io
 from PIL import Image as PILImage
 
+W_P, W_TBL = qn('w:p'), qn('w:tbl')
+
 class Offer3Template:
     """
     Standard professional quotation template
@@ -33,6 +38,9 @@ class Offer3Template:
         self.color_text_dark = "000000"
         self.color_text_light = "666666"
         
+        # Cached <w:rPr> elements for table cell runs (see _run_properties)
+        self._run_props = {}
+        
     def copy_header_footer_from_template(self, template_path):
         """
         Copy header and footer directly from Offer 2 template to Offer 3
@@ -78,13 +86,11 @@ class Offer3Template:
                 print("Copying header paragraphs and tables...", flush=True)
                 
                 # Clear our header
-                for paragraph in our_section.header.paragraphs:
-                    p = paragraph._element
-                    p.getparent().remove(p)
-                
-                for table in our_section.header.tables:
-                    t = table._element
-                    t.getparent().remove(t)
+                # One pass over its children, no python-docx proxy objects
+                header = our_section.header._element
+                for element in list(header):
+                    if element.tag in (W_P, W_TBL):
+                        header.remove(element)
                 
                 # Copy paragraphs (but this won't copy images in headers)
                 for para in template_section.header.paragraphs:
@@ -115,13 +121,11 @@ class Offer3Template:
                 print("Copying footer paragraphs and tables...", flush=True)
                 
                 # Clear our footer
-                for paragraph in our_section.footer.paragraphs:
-                    p = paragraph._element
-                    p.getparent().remove(p)
-                
-                for table in our_section.footer.tables:
-                    t = table._element
-                    t.getparent().remove(t)
+                # One pass over its children, no python-docx proxy objects
+                footer = our_section.footer._element
+                for element in list(footer):
+                    if element.tag in (W_P, W_TBL):
+                        footer.remove(element)
                 
                 # Copy paragraphs
                 for para in template_section.footer.paragraphs:
@@ -293,27 +297,30 @@ class Offer3Template:
         self._set_cell_text(header_cells[3], "Unit Price", bold=True, bg_color=self.color_header_bg, text_color="FFFFFF")
         self._set_cell_text(header_cells[4], "Total", bold=True, bg_color=self.color_header_bg, text_color="FFFFFF")
         
-        # Group items by category
-        from collections import OrderedDict
-        categorized = OrderedDict()
+        # Blank body rows (column widths applied, category/totals spans
+        # pre-merged) cloned for every new row
+        row_template = self._detached_row(pricing_table)
+        category_template = self._detached_row(pricing_table, merge=(0, 4))
+        totals_template = self._detached_row(pricing_table, merge=(0, 3))
+        
+        # Group items by category (dicts keep first-seen category order)
+        categorized = defaultdict(list)
         for item in items:
-            cat = item.get('category', 'Items')
-            if cat not in categorized:
-                categorized[cat] = []
-            categorized[cat].append(item)
+            categorized[item.get('category', 'Items')].append(item)
         
+        # Rows are built detached and appended to the table in one go
+        rows = []
         item_counter = 1
         
         # Add items by category
         for category, cat_items in categorized.items():
             # Category header row
-            cat_row = pricing_table.add_row().cells
-            cat_row[0].merge(cat_row[4])
+            cat_row = self._clone_row(pricing_table, category_template, rows)
             self._set_cell_text(cat_row[0], category, bold=True, bg_color="E7E6E6")
             
             # Items in category
             for item in cat_items:
-                row = pricing_table.add_row().cells
+                row = self._clone_row(pricing_table, row_template, rows)
                 
                 # No.
                 self._set_cell_text(row[0], str(item_counter), align="center")
@@ -331,15 +338,16 @@ class Offer3Template:
                 unit_price = item.get('unit_price', '')
                 self._set_cell_text(row[3], str(unit_price), align="right")
                 
-                # Total
-                total = item.get('total_price', item.get('unit_price', ''))
+                # Total (falls back to the unit price already read above)
+                total = item.get('total_price', unit_price)
                 self._set_cell_text(row[4], str(total), align="right")
         
         # Add totals row if needed (placeholder for now)
-        totals_row = pricing_table.add_row().cells
-        totals_row[0].merge(totals_row[3])
+        totals_row = self._clone_row(pricing_table, totals_template, rows)
         self._set_cell_text(totals_row[0], "TOTAL:", bold=True, align="right")
-        self._set_cell_text(totals_row[4], "", bold=True, align="right")
+        self._set_cell_text(totals_row[1], "", bold=True, align="right")
+        
+        pricing_table._tbl.extend(rows)
         
         # Spacing after table
         self.doc.add_paragraph()
@@ -360,21 +368,25 @@ class Offer3Template:
         
         self.doc.add_paragraph()
         
-        item_counter = 1
-        for item in items:
-            description = item.get('description', '')
-            specifications = item.get('specifications', '')
-            details = item.get('details', '')
-            
+        # All description strings are built up front, before the docx tree
+        # is touched; the loop below only adds paragraphs
+        texts = self._technical_texts(items)
+        
+        # Sizes and color shared by every item, built once
+        heading_size = Pt(12)
+        body_size = Pt(self.font_size_body)
+        small_size = Pt(self.font_size_small)
+        gray = RGBColor(102, 102, 102)
+        
+        for item_counter, (item, (description, specifications, details)) in enumerate(zip(items, texts), 1):
             # Skip items with no technical content
-            if not description and not specifications and not details:
-                item_counter += 1
+            if not (description or specifications or details):
                 continue
             
             # Item heading
             item_heading = self.doc.add_paragraph()
             run = item_heading.add_run(f"{item_counter}. {item.get('item_name', 'Item')}")
-            run.font.size = Pt(12)
+            run.font.size = heading_size
             run.font.bold = True
             run.font.name = self.font_name
             
@@ -382,7 +394,7 @@ class Offer3Template:
             if description:
                 desc_para = self.doc.add_paragraph()
                 run = desc_para.add_run(description)
-                run.font.size = Pt(self.font_size_body)
+                run.font.size = body_size
                 run.font.name = self.font_name
                 self.doc.add_paragraph()
             
@@ -391,12 +403,12 @@ class Offer3Template:
                 spec_heading = self.doc.add_paragraph()
                 run = spec_heading.add_run("Key Specifications:")
                 run.font.bold = True
-                run.font.size = Pt(self.font_size_body)
+                run.font.size = body_size
                 run.font.name = self.font_name
                 
                 spec_para = self.doc.add_paragraph()
                 run = spec_para.add_run(specifications)
-                run.font.size = Pt(self.font_size_body)
+                run.font.size = body_size
                 run.font.name = self.font_name
                 self.doc.add_paragraph()
             
@@ -404,15 +416,26 @@ class Offer3Template:
             if details:
                 details_para = self.doc.add_paragraph()
                 run = details_para.add_run(details)
-                run.font.size = Pt(self.font_size_small)
+                run.font.size = small_size
                 run.font.name = self.font_name
-                run.font.color.rgb = RGBColor(102, 102, 102)  # Gray text
+                run.font.color.rgb = gray
                 self.doc.add_paragraph()
-            
-            item_counter += 1
         
         self.doc.add_paragraph()
     
+    def _technical_texts(self, items):
+        """
+        Return (description, specifications, details) strings for each item,
+        flattening dict specifications to "key: value, ..." once
+        """
+        texts = []
+        for item in items:
+            specifications = item.get('specifications') or ''
+            if isinstance(specifications, dict):
+                specifications = ", ".join(f"{k}: {v}" for k, v in specifications.items())
+            texts.append((item.get('description') or '', specifications, item.get('details') or ''))
+        return texts
+    
     def add_commercial_terms(self, company_data, supplier_terms=None):
         """
         Add commercial terms section
@@ -495,32 +518,63 @@ class Offer3Template:
     
     # Helper methods
     
+    def _detached_row(self, table, merge=None):
+        """
+        Blank body row of table to clone rows from, optionally with cells
+        merge=(first, last) already merged; not left in the table
+        """
+        row = table.add_row()
+        if merge:
+            first, last = merge
+            row.cells[first].merge(row.cells[last])
+        table._tbl.remove(row._tr)
+        return row._tr
+    
+    def _clone_row(self, table, row_template, rows):
+        """Copy a template <w:tr> into rows and return its cells"""
+        tr = deepcopy(row_template)
+        rows.append(tr)
+        return [_Cell(tc, table) for tc in tr.tc_lst]
+    
     def _set_cell_text(self, cell, text, bold=False, align="left", bg_color=None, text_color=None):
         """Set cell text with formatting"""
-        cell.text = ""  # Clear existing
-        para = cell.paragraphs[0]
-        run = para.add_run(str(text))
-        
-        run.font.name = self.font_name
-        run.font.size = Pt(self.font_size_body)
-        run.font.bold = bold
-        
-        if text_color:
-            if len(text_color) == 6:
-                run.font.color.rgb = RGBColor(
-                    int(text_color[0:2], 16),
-                    int(text_color[2:4], 16),
-                    int(text_color[4:6], 16)
-                )
+        tc = cell._tc
+        tc.clear_content()  # Clear existing
+        p = tc.add_p()
+        r = p.add_r()
+        r.append(deepcopy(self._run_properties(bold, text_color)))
+        r.text = str(text)
         
         if align == "center":
-            para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            p.alignment = WD_ALIGN_PARAGRAPH.CENTER
         elif align == "right":
-            para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+            p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
         
         if bg_color:
             self._set_cell_background(cell, bg_color)
     
+    def _run_properties(self, bold, text_color):
+        """
+        <w:rPr> for a cell run (font, size, bold, color), built once per
+        combination and cloned into each run instead of set via run.font
+        """
+        key = (bold, text_color)
+        rpr = self._run_props.get(key)
+        if rpr is None:
+            weight = '<w:b/>' if bold else '<w:b w:val="0"/>'
+            color = ''
+            if text_color and len(text_color) == 6:
+                color = f'<w:color w:val="{text_color.upper()}"/>'
+            rpr = parse_xml(
+                f'<w:rPr {nsdecls("w")}>'
+                f'<w:rFonts w:ascii="{self.font_name}" w:hAnsi="{self.font_name}"/>'
+                f'{weight}{color}'
+                f'<w:sz w:val="{self.font_size_body * 2}"/>'
+                '</w:rPr>'
+            )
+            self._run_props[key] = rpr
+        return rpr
+    
     def _set_cell_background(self, cell, color_hex):
         """Set cell background color"""
         shading_elm = OxmlElement('w:shd')